@@ -1,11 +1,15 @@
 # Ensure proper logging by always importing logger.py first in app.py
 from tsviewer.logger import logger
+import posixpath
 import random
 import typing
+from urllib.parse import quote
 from uuid import uuid4
 
-from flask import Flask, render_template, session, redirect, url_for, request, Response, make_response
-from functools import wraps
+import ts3
+from flask import Flask, render_template, session, redirect, url_for, request, Response, make_response, send_file, g, \
+    abort
+from functools import partial, wraps
 
 from tsviewer.channel_uploads import ChannelUploads
 from tsviewer.user import User
@@ -16,6 +20,14 @@ from tsviewer.path_utils import create_directories, get_application_name
 from tsviewer.configuration import Configuration
 from tsviewer.session_interface import TsViewerSecureCookieSessionInterface
 from tsviewer.ts_file import File
+from tsviewer.user_events import UserListBroadcaster
+from tsviewer.json_snapshots import JsonSnapshotCache
+from tsviewer.download_cache import DownloadCache
+from tsviewer.file_transfers import stream_download, get_byte_range, IncompleteTransferException, \
+    RangeNotSatisfiableException
+from tsviewer.servers import ServerRegistry
+from tsviewer.refresh_scheduler import RefreshScheduler
+from tsviewer.client_rules import RuleConflictException
 
 configuration = Configuration.get_instance()
 
@@ -30,9 +42,44 @@ def create_successful_plain_text_response(text: str) -> Response:
     return response
 
 
+def create_conditional_json_response(snapshots: JsonSnapshotCache, resource: str, version: typing.Optional[int],
+                                     build: typing.Callable[[], typing.Any]) -> Response:
+    """
+    Answer with `304 Not Modified`, if the client already has the current version of the resource. Otherwise, the
+    (cached) JSON body is returned together with its ETag. A known version is answered without building the body
+    """
+    if version is not None and request.if_none_match.contains(snapshots.etag(resource, version)):
+        etag, body = snapshots.etag(resource, version), None
+    else:
+        etag, body = snapshots.get(resource, version, build)
+        if request.if_none_match.contains(etag):
+            body = None
+    response = make_response(body if body is not None else str())
+    response.status_code = 200 if body is not None else 304
+    if body is not None:
+        response.headers['Content-Type'] = 'application/json'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def get_file_page_arguments(recursive: bool) -> dict[str, typing.Any]:
+    """
+    Read the paging and sorting arguments of the file routes from the query string
+    :param recursive: Default for the `recursive` argument
+    :return: Keyword arguments for `ChannelUploads.get_file_page`
+    """
+    return {'path': request.args.get('path', '/'),
+            'page': request.args.get('page', 1, type=int),
+            'page_size': min(request.args.get('page_size', 50, type=int), 500),
+            'recursive': request.args.get('recursive', '1' if recursive else '0') == '1',
+            'sort': request.args.get('sort', 'name'),
+            'descending': request.args.get('order', 'asc') == 'desc'}
+
+
 def get_user_list(ts_client: TsViewerClient) -> list[User]:
     if ts_client.connection is None or configuration.debug:
-        users = [build_fake_user() for _ in range(10)]
+        users = [build_fake_user(client_id=str(index)) for index in range(10)]
     else:
         users = ts_client.get_user_list()
     return users
@@ -62,18 +109,47 @@ def check_password(func) -> typing.Callable:
     return decorated_function
 
 
+def check_admin(func) -> typing.Callable:
+    @wraps(func)
+    @check_password
+    def decorated_function(*args, **kwargs) -> typing.Any:
+        """
+        Only let admins through. Authenticated users, that are no admins, are answered with `403 Forbidden`
+        """
+        if not is_admin(session):
+            return make_response('Admin role required', 403)
+        return func(*args, **kwargs)
+
+    return decorated_function
+
+
 if __name__ in ['__main__', get_application_name()]:
     message = create_directories()
     if message:
         logger.warn(message)
 
-    client = TsViewerClient()
-    uploads = ChannelUploads(client)
-    client.uploads = uploads
+    servers = ServerRegistry()
+    # Requests read the snapshots of the scheduler, so they don't wait for the Server Query
+    scheduler = RefreshScheduler()
+    for monitored_server in servers:
+        scheduler.add(f'{monitored_server.key}/users', partial(get_user_list, monitored_server.client),
+                      configuration.refresh_users_interval)
+        scheduler.add(f'{monitored_server.key}/channels', monitored_server.client.get_channel_list,
+                      configuration.refresh_channels_interval)
+        # Background refreshes take one pooled connection each, the others are left to the requests
+        scheduler.add(f'{monitored_server.key}/files',
+                      partial(monitored_server.uploads.get_files, refresh=True, max_connections=1),
+                      configuration.refresh_files_interval)
+        # The user events refresh the scheduled user list, so a state change costs one query for both
+        monitored_server.user_events = UserListBroadcaster(monitored_server.client.state,
+                                                           partial(scheduler.refresh, f'{monitored_server.key}/users'))
+        monitored_server.user_events.start()
+    scheduler.start()
     if configuration.clean_up_upload_channel:
         def execute_clean_up() -> None:
-            uploads.clean_up()
-            uploads.download_avatars_to_static_folder()
+            # The upload channel is configured for the default server only
+            servers.default.uploads.clean_up()
+            servers.default.uploads.download_avatars_to_static_folder()
 
 
         from threading import Thread
@@ -88,14 +164,45 @@ if __name__ in ['__main__', get_application_name()]:
     app = Flask(get_application_name(), template_folder='template')
 
     logger.info('Flask application setup and running')
+    snapshots = JsonSnapshotCache()
+    download_cache = DownloadCache()
     app.session_interface = TsViewerSecureCookieSessionInterface(configuration.cookie_signing_salt)
     app.secret_key = configuration.cookie_secret_key
 
 
-    @app.route("/", methods=['GET', 'POST'])
+    def server_route(rule: str, **options) -> typing.Callable:
+        """
+        Register a view for the default server at `rule` and for every watched virtual server at
+        `/servers/<server_id><rule>`. The view finds its server in `g.server`
+        """
+        def decorator(func: typing.Callable) -> typing.Callable:
+            app.add_url_rule(rule, view_func=func, **options)
+            app.add_url_rule('/servers/<server_id>' + rule, view_func=func, **options)
+            return func
+
+        return decorator
+
+
+    @app.url_value_preprocessor
+    def select_server(endpoint: typing.Optional[str], values: typing.Optional[dict]) -> None:
+        g.server = servers.get(values.pop('server_id', None) if values else None)
+        if g.server is None:
+            abort(404)
+
+
+    @app.url_defaults
+    def add_server_id(endpoint: str, values: dict) -> None:
+        # Links within a page of another server keep pointing to that server
+        server = g.get('server')
+        if server is not None and server is not servers.default and 'server_id' not in values \
+                and app.url_map.is_endpoint_expecting(endpoint, 'server_id'):
+            values['server_id'] = server.key
+
+
+    @server_route("/", methods=['GET', 'POST'])
     @check_password
     def index():
-        users = get_user_list(client)
+        users = scheduler.get(f'{g.server.key}/users')
         # avatars.update_avatars(users)
 
         # multiply users times 10 for testing purposes
@@ -104,6 +211,61 @@ if __name__ in ['__main__', get_application_name()]:
                                is_admin=is_admin(session))
 
 
+    @app.route('/api/v1/servers', methods=['GET'])
+    @check_password
+    def api_servers():
+        return [{'server_id': server.server_id, 'default': server is servers.default,
+                 'url': url_for('index') if server is servers.default else url_for('index', server_id=server.key)}
+                for server in servers]
+
+
+    @server_route('/events/users', methods=['GET'])
+    @check_password
+    def users_events():
+        return Response(g.server.user_events.stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+    @server_route('/api/v1/users', methods=['GET'])
+    @check_password
+    def api_users():
+        users, version = scheduler.snapshot(f'{g.server.key}/users')
+        return create_conditional_json_response(snapshots, f'{g.server.key}/users', version,
+                                                lambda: [user.to_dict() for user in users])
+
+
+    @server_route('/api/v1/channels', methods=['GET'])
+    @check_password
+    def api_channels():
+        channels, version = scheduler.snapshot(f'{g.server.key}/channels')
+        return create_conditional_json_response(snapshots, f'{g.server.key}/channels', version, lambda: [
+            {'cid': channel.get('cid'), 'pid': channel.get('pid'), 'name': channel.get('channel_name'),
+             'order': channel.get('channel_order')} for channel in channels])
+
+
+    @server_route('/api/v1/files', methods=['GET'])
+    @check_password
+    def api_files():
+        uploads = g.server.uploads
+        uploads.get_files()
+        return create_conditional_json_response(snapshots, f'{g.server.key}/files', uploads.version, lambda: {
+            cid: [File(**file).to_dict() for file in files] for cid, files in uploads.channel_to_file_map.items()})
+
+
+    @server_route('/api/v1/files/<channel_id>', methods=['GET'])
+    @check_password
+    def api_channel_files(channel_id: str):
+        arguments = get_file_page_arguments(recursive=True)
+        try:
+            entries, has_next_page = g.server.uploads.get_file_page(channel_id, **arguments)
+        except ValueError as error:
+            return make_response(str(error), 400)
+        return create_conditional_json_response(snapshots, f'{g.server.key}/channel-files', None, lambda: {
+            'cid': channel_id, 'path': arguments['path'], 'page': arguments['page'],
+            'page_size': arguments['page_size'], 'next_page': arguments['page'] + 1 if has_next_page else None,
+            'files': [File(**entry).to_dict() for entry in entries]})
+
+
     @app.route('/logout', methods=['POST'])
     def logout():
         session.clear()
@@ -126,61 +288,181 @@ if __name__ in ['__main__', get_application_name()]:
         return render_template('login.html')
 
 
-    @app.route('/files', methods=['GET'])
+    @server_route('/files', methods=['GET'])
     @check_password
     def files():
-        uploaded_files = uploads.get_files()
-        file_list = list()
-        for uploaded_file in uploaded_files[0]:
-            file_list.append(File(**uploaded_file))
-        return render_template('files.html', files=file_list)
+        channel_id = request.args.get('cid', configuration.upload_channel_id)
+        arguments = get_file_page_arguments(recursive=False)
+        try:
+            entries, has_next_page = g.server.uploads.get_file_page(channel_id, **arguments)
+        except ValueError as error:
+            return make_response(str(error), 400)
+        return render_template('files.html', files=[File(**entry) for entry in entries], channel_id=channel_id,
+                               has_next_page=has_next_page, parent_path=posixpath.dirname(arguments['path']),
+                               directory_type=ChannelUploads.DIRECTORY_TYPE, join_path=posixpath.join, **arguments)
+
+
+    @server_route('/upload/<channel_id>', methods=['POST'])
+    @check_password
+    def upload(channel_id: str):
+        # The body is the raw file content. It is streamed to the Teamspeak server, so `request.files` and
+        # `request.form` must not be touched, because they would buffer the whole body
+        file_name = request.args.get('name', str())
+        if not file_name or '/' in file_name or request.content_length is None:
+            return make_response('A file name and a Content-Length are required', 400)
+        # Only admins may replace an existing file
+        overwrite = request.args.get('overwrite') == '1'
+        if overwrite and not is_admin(session):
+            return make_response('Admin role required to overwrite a file', 403)
+        try:
+            if not g.server.client.upload_stream(request.stream, request.content_length, channel_id, file_name,
+                                                 overwrite):
+                return make_response('Upload failed', 502)
+        except FileExistsError as error:
+            return make_response(str(error), 409)
+        g.server.uploads.invalidate_files()
+        return create_successful_plain_text_response('File uploaded')
 
 
-    @app.route('/kick_from_server/<client_id>/<reason>', methods=['GET'])
+    @server_route('/download/<channel_id>/<path:file_path>', methods=['GET'])
+    @check_password
+    def download(channel_id: str, file_path: str):
+        client = g.server.client
+        file_info = client.get_file_info(file_path, channel_id)
+        if file_info is None:
+            return make_response('File not found', 404)
+        size = int(file_info.get('size', 0))
+        file_name = posixpath.basename(file_path)
+        cache_key = DownloadCache.key(g.server.server_id, channel_id, file_path, file_info)
+        cached_path = download_cache.lookup(cache_key) if download_cache.enabled else None
+        if cached_path is not None:
+            return send_file(cached_path, as_attachment=True, download_name=file_name, conditional=True)
+
+        try:
+            byte_range = get_byte_range(request.range, size)
+        except RangeNotSatisfiableException:
+            response = make_response('Requested range not satisfiable', 416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+        start, stop = byte_range if byte_range is not None else (0, size)
+        # The transfer is started before the response, so a failure is still answered with an error status
+        try:
+            transfer = client.init_file_download(file_path, channel_id, seekpos=start)
+            chunks = stream_download(transfer, start, stop - start)
+        except FileNotFoundError:
+            return make_response('File not found', 404)
+        except (ts3.query.TS3QueryError, IncompleteTransferException, OSError) as error:
+            logger.error(error)
+            return make_response('Download failed', 502)
+        if byte_range is None and download_cache.accepts(size):
+            chunks = download_cache.write_through(cache_key, chunks)
+        response = Response(chunks, status=206 if byte_range is not None else 200,
+                            mimetype='application/octet-stream', direct_passthrough=True)
+        response.headers['Content-Length'] = str(stop - start)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['Content-Disposition'] = f'attachment; filename*=UTF-8\'\'{quote(file_name)}'
+        if byte_range is not None:
+            response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        return response
+
+
+    @server_route('/api/v1/clients/move', methods=['POST'])
+    @check_admin
+    def api_move_clients():
+        # Body: {"moves": [{"clid": "5", "cid": "2"}, ...]}
+        moves = (request.get_json(silent=True) or dict()).get('moves')
+        if not isinstance(moves, list) or not all(isinstance(move, dict) and move.get('clid') and move.get('cid')
+                                                  for move in moves):
+            return make_response('A list of moves with a clid and a cid each is required', 400)
+        errors = g.server.client.move_clients([(str(move['clid']), str(move['cid'])) for move in moves])
+        return {'results': [{'clid': client_id, 'error': error} for client_id, error in errors.items()]}
+
+
+    @server_route('/api/v1/rules', methods=['GET'])
+    @check_admin
+    def api_rules():
+        if g.server.rules is None:
+            return []
+        return [rule.to_dict() for rule in g.server.rules.get_rules()]
+
+
+    @server_route('/api/v1/rules', methods=['POST'])
+    @check_admin
+    def api_add_rule():
+        # Body: {"type": "keep_away", "clid": "5", "cid": "2"} or {"type": "follow", "clid": "5", "target_clid": "7"}
+        if g.server.rules is None:
+            return make_response('Rules need server_state_enabled', 409)
+        body = request.get_json(silent=True) or dict()
+        try:
+            if body.get('type') == 'keep_away' and body.get('clid') and body.get('cid'):
+                rule = g.server.rules.add_keep_away(body['clid'], body['cid'])
+            elif body.get('type') == 'follow' and body.get('clid') and body.get('target_clid'):
+                rule = g.server.rules.add_follow(body['clid'], body['target_clid'])
+            else:
+                return make_response('A keep_away rule needs a clid and a cid, a follow rule a clid and a target_clid',
+                                     400)
+        except ValueError as error:
+            return make_response(str(error), 400)
+        except RuleConflictException as error:
+            return make_response(str(error), 409)
+        return rule.to_dict(), 201
+
+
+    @server_route('/api/v1/rules/<rule_id>', methods=['DELETE'])
+    @check_admin
+    def api_remove_rule(rule_id: str):
+        if g.server.rules is None or not g.server.rules.remove(rule_id):
+            return make_response('Rule not found', 404)
+        return create_successful_plain_text_response('Rule removed')
+
+
+    @server_route('/kick_from_server/<client_id>/<reason>', methods=['GET'])
     @check_password
     def kick_from_server(client_id: str, reason: str = 'Go away'):
         # TODO: The site should refresh after a kick or the kicked user should be removed from DOM
         # TODO: Exceptions should be handled in client and not in routing
         try:
-            client.connection.clientkick(reasonid=KickClientIdentifiers.FROM_SERVER, reasonmsg=reason, clid=client_id)
+            g.server.client.connection.clientkick(reasonid=KickClientIdentifiers.FROM_SERVER, reasonmsg=reason,
+                                                  clid=client_id)
         except Exception as error:
             logger.error(error)
         return create_successful_plain_text_response('User kicked from server')
 
 
-    @app.route('/kick_from_channel/<client_id>/<reason>', methods=['GET'])
+    @server_route('/kick_from_channel/<client_id>/<reason>', methods=['GET'])
     @check_password
     def kick_from_channel(client_id: str, reason: str = 'Go away'):
         try:
-            client.connection.clientkick(reasonid=KickClientIdentifiers.FROM_CHANNEL, reasonmsg=reason, clid=client_id)
+            g.server.client.connection.clientkick(reasonid=KickClientIdentifiers.FROM_CHANNEL, reasonmsg=reason,
+                                                  clid=client_id)
         except Exception as error:
             logger.error(error)
         return create_successful_plain_text_response('User kicked from channel')
 
 
-    @app.route('/poke/<client_id>/<message>')
+    @server_route('/poke/<client_id>/<message>')
     @check_password
     def poke(client_id: str, message: str = None):
-        client.poke_client(message, client_id)
+        g.server.client.poke_client(message, client_id)
         return create_successful_plain_text_response('User poked')
 
 
-    @app.route('/send_message_to_server/<message>')
+    @server_route('/send_message_to_server/<message>')
     @check_password
     def send_message_to_server(message: str):
-        client.send_message_to_server(message)
+        g.server.client.send_message_to_server(message)
         return create_successful_plain_text_response('Message sent to server')
 
 
-    @app.route('/send_message_to_client/<client_id>/<message>')
+    @server_route('/send_message_to_client/<client_id>/<message>')
     @check_password
     def send_message_to_client(client_id: str, message: str):
-        client.send_message_to_client(message, client_id)
+        g.server.client.send_message_to_client(message, client_id)
         return create_successful_plain_text_response('Message sent to client')
 
 
-    @app.route('/send_message_to_channel/<channel_id>/<message>')
+    @server_route('/send_message_to_channel/<channel_id>/<message>')
     @check_password
     def send_message_to_channel(channel_id: str, message: str):
-        client.send_message_to_channel(channel_id, message)
+        g.server.client.send_message_to_channel(channel_id, message)
         return create_successful_plain_text_response('Message sent to channel')
@@ -1,11 +1,89 @@
-function kickFromServer(clientId) {
+function kickFromServer(url) {
     $.ajax({
         type: "GET",
-        url: "/kick_from_server/" + clientId + "/Go%20Away%21",
+        url: url,
     })
     const container = document.querySelector('.alerts');
     const alert = container.querySelector('sl-alert');
     alert.toast();
 }
 
+function fillUserEntry(entry, user, staticUrl) {
+    entry.dataset.clientId = user.client_id;
+    entry.querySelector('.user-name').textContent = user.name;
+    entry.querySelector('.user-idle-time').textContent = user.idle_time;
+    entry.querySelector('.user-microphone-status').setAttribute('name', user.microphone_status);
+    entry.querySelector('.user-sound-status').setAttribute('name', user.sound_status);
+    const avatar = entry.querySelector('.user-avatar');
+    if (avatar) {
+        avatar.hidden = !user.avatar_file_name;
+        if (user.avatar_file_name) {
+            avatar.src = staticUrl + user.avatar_file_name;
+        }
+    }
+}
+
+function findUserEntry(clientId) {
+    return document.querySelector('.user-entry[data-client-id="' + CSS.escape(String(clientId)) + '"]');
+}
+
+function addUserEntry(user, staticUrl, kickUrl) {
+    const template = document.getElementById('user-entry-template');
+    const entry = template.content.firstElementChild.cloneNode(true);
+    entry.querySelector('.user-kick').addEventListener('click', function() {
+        // The kick URL is built by the server, so it keeps the prefix of the viewed virtual server
+        kickFromServer(kickUrl.replace('__client_id__', encodeURIComponent(entry.dataset.clientId)));
+    });
+    fillUserEntry(entry, user, staticUrl);
+    document.querySelector('.main').appendChild(entry);
+}
+
+function subscribeToUserEvents(url, staticUrl, kickUrl) {
+    const source = new EventSource(url);
+    source.addEventListener('snapshot', function(event) {
+        const users = JSON.parse(event.data);
+        document.querySelectorAll('.main .user-entry').forEach(function(entry) {
+            entry.remove();
+        });
+        users.forEach(function(user) {
+            addUserEntry(user, staticUrl, kickUrl);
+        });
+    });
+    source.addEventListener('diff', function(event) {
+        const diff = JSON.parse(event.data);
+        diff.left.forEach(function(clientId) {
+            const entry = findUserEntry(clientId);
+            if (entry) {
+                entry.remove();
+            }
+        });
+        diff.joined.forEach(function(user) {
+            addUserEntry(user, staticUrl, kickUrl);
+        });
+        diff.changed.forEach(function(user) {
+            const entry = findUserEntry(user.client_id);
+            if (entry) {
+                fillUserEntry(entry, user, staticUrl);
+            } else {
+                addUserEntry(user, staticUrl, kickUrl);
+            }
+        });
+    });
+}
 
+function uploadFile(url, input) {
+    const file = input.files[0];
+    if (!file) {
+        return;
+    }
+    // The raw file is sent as the request body, so the server can stream it without buffering a multipart form
+    fetch(url + '?name=' + encodeURIComponent(file.name), {method: 'POST', body: file}).then(function(response) {
+        if (response.ok) {
+            window.location.reload();
+        } else {
+            response.text().then(function(message) {
+                alert(message);
+            });
+        }
+    });
+}
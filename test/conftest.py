@@ -0,0 +1,7 @@
+from pathlib import Path
+
+from tsviewer.configuration import Configuration
+
+# `tsviewer.logger` opens the log file as soon as it is imported, so its directory has to exist before the tests are
+# collected
+Path(Configuration.get_instance().log_path).parent.mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,98 @@
+import unittest
+from queue import Empty
+
+from tsviewer.client_rules import ClientRuleEngine, RuleConflictException
+from tsviewer.server_state import ServerState
+
+
+class FakeClient(object):
+    """
+    Stands in for the `TsViewerClient`. Moves are applied to the state the way the server announces them
+    """
+
+    def __init__(self) -> None:
+        self.server_id = 1
+        self.state = ServerState()
+        self.state.reset([{'clid': '1', 'cid': '1'}, {'clid': '2', 'cid': '2'}, {'clid': '3', 'cid': '3'}],
+                         [{'cid': '1', 'pid': '0'}, {'cid': '2', 'pid': '0'}, {'cid': '3', 'pid': '0'}])
+        self.moves: list[tuple[str, str]] = list()
+
+    def move_clients(self, moves: list[tuple[str, str]]) -> dict[str, None]:
+        self.moves.extend(moves)
+        for client_id, channel_id in moves:
+            self.state.apply('notifyclientmoved', [{'ctid': channel_id, 'reasonid': '1', 'clid': client_id}])
+        return {client_id: None for client_id, _ in moves}
+
+
+class ClientRuleEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeClient()
+        self.engine = ClientRuleEngine(self.client)
+
+    def enforce_pending(self) -> None:
+        client_ids = set()
+        try:
+            while True:
+                client_ids.add(self.engine._pending.get_nowait())
+        except Empty:
+            pass
+        if client_ids:
+            self.engine._enforce(client_ids)
+
+    def test_client_cannot_follow_itself(self):
+        with self.assertRaises(ValueError):
+            self.engine.add_follow('1', '1')
+
+    def test_direct_cycle_is_rejected(self):
+        self.engine.add_follow('1', '2')
+        with self.assertRaises(RuleConflictException):
+            self.engine.add_follow('2', '1')
+        self.assertEqual(1, len(self.engine.get_rules()))
+
+    def test_indirect_cycle_is_rejected(self):
+        self.engine.add_follow('1', '2')
+        self.engine.add_follow('2', '3')
+        with self.assertRaises(RuleConflictException):
+            self.engine.add_follow('3', '1')
+        self.assertEqual(2, len(self.engine.get_rules()))
+
+    def test_replaced_follow_rule_does_not_close_a_cycle(self):
+        self.engine.add_follow('1', '2')
+        self.engine.add_follow('1', '3')
+        self.engine.add_follow('2', '1')
+        self.assertEqual({('1', '3'), ('2', '1')},
+                         {(rule.follower_client_id, rule.chased_client_id) for rule in self.engine.get_rules()})
+
+    def test_own_moves_do_not_trigger_the_rules_again(self):
+        self.engine.add_follow('1', '2')
+        self.enforce_pending()
+        self.assertEqual([('1', '2')], self.client.moves)
+        self.assertEqual('2', self.client.state.get_client_channel_id('1'))
+        self.assertTrue(self.engine._pending.empty())
+
+    def test_followers_follow_a_moved_client(self):
+        self.engine.add_follow('1', '2')
+        self.engine.add_follow('3', '1')
+        self.enforce_pending()
+        self.enforce_pending()
+        self.assertEqual('2', self.client.state.get_client_channel_id('1'))
+        self.assertEqual('2', self.client.state.get_client_channel_id('3'))
+        self.assertTrue(self.engine._pending.empty())
+
+    def test_moves_of_others_are_enforced(self):
+        self.engine.add_follow('1', '2')
+        self.enforce_pending()
+        self.client.state.apply('notifyclientmoved', [{'ctid': '3', 'reasonid': '0', 'clid': '1'}])
+        self.enforce_pending()
+        self.assertEqual('2', self.client.state.get_client_channel_id('1'))
+
+    def test_rules_are_removed_when_a_client_leaves(self):
+        self.engine.add_follow('1', '2')
+        self.engine.add_keep_away('3', '1')
+        self.client.state.apply('notifyclientleftview', [{'cfid': '2', 'ctid': '0', 'reasonid': '8', 'clid': '2'}])
+        self.assertEqual(['keep_away'], [rule.to_dict()['type'] for rule in self.engine.get_rules()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+from werkzeug.http import parse_range_header
+
+from tsviewer.file_transfers import get_byte_range, RangeNotSatisfiableException
+
+
+class GetByteRangeTest(unittest.TestCase):
+
+    def test_no_range_transfers_the_whole_file(self):
+        self.assertIsNone(get_byte_range(None, 100))
+
+    def test_closed_range(self):
+        self.assertEqual((10, 20), get_byte_range(parse_range_header('bytes=10-19'), 100))
+
+    def test_open_range(self):
+        self.assertEqual((95, 100), get_byte_range(parse_range_header('bytes=95-'), 100))
+
+    def test_suffix_range(self):
+        self.assertEqual((90, 100), get_byte_range(parse_range_header('bytes=-10'), 100))
+
+    def test_range_is_clipped_to_the_file_size(self):
+        self.assertEqual((90, 100), get_byte_range(parse_range_header('bytes=90-200'), 100))
+
+    def test_multiple_ranges_transfer_the_whole_file(self):
+        self.assertIsNone(get_byte_range(parse_range_header('bytes=0-1,5-6'), 100))
+
+    def test_range_behind_the_end_of_the_file(self):
+        with self.assertRaises(RangeNotSatisfiableException):
+            get_byte_range(parse_range_header('bytes=200-300'), 100)
+
+    def test_range_of_an_empty_file(self):
+        with self.assertRaises(RangeNotSatisfiableException):
+            get_byte_range(parse_range_header('bytes=0-'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import copy
+import unittest
+
+import ts3
+from ts3.escape import TS3Escape
+from ts3.response import TS3QueryResponse
+
+from tsviewer.configuration import Configuration
+from tsviewer.query_connection import QueryConnection, QueryBatch
+
+
+class FakeQueryConnection(QueryConnection):
+    """
+    Answers every pipelined command with the command itself, `clientmove` commands fail. No server is needed
+    """
+
+    def __init__(self, flood_commands: int) -> None:
+        configuration = copy.copy(Configuration.get_instance())
+        configuration.query_flood_commands = flood_commands
+        configuration.query_flood_time = 0
+        super().__init__(configuration)
+        self.chunks: list[int] = list()
+
+    def is_connected(self) -> bool:
+        return True
+
+    def _pipeline(self, query: bytes, count: int) -> list[TS3QueryResponse]:
+        lines = [line.decode() for line in query.split(b'\n\r') if line]
+        self.chunks.append(len(lines))
+        return [TS3QueryResponse(b'error id=768 msg=invalid\\schannelID' if line.startswith('clientmove') else
+                                 f'command={TS3Escape.escape(line)}\n\rerror id=0 msg=ok'.encode())
+                for line in lines]
+
+
+class QueryBatchTest(unittest.TestCase):
+
+    def test_results_are_in_the_order_of_the_commands(self):
+        connection = FakeQueryConnection(flood_commands=10)
+        batch = QueryBatch()
+        results = [batch.clientinfo(clid=client_id) for client_id in range(5)]
+        self.assertEqual(5, len(batch))
+        batch.flush(connection)
+        self.assertEqual(0, len(batch))
+        self.assertEqual([f'clientinfo clid={client_id}' for client_id in range(5)],
+                         [result.result().parsed[0]['command'].strip() for result in results])
+        self.assertEqual([5], connection.chunks)
+
+    def test_order_is_kept_across_chunks(self):
+        connection = FakeQueryConnection(flood_commands=3)
+        batch = QueryBatch()
+        results = [batch.clientinfo(clid=client_id) for client_id in range(8)]
+        batch.flush(connection)
+        self.assertEqual([3, 3, 2], connection.chunks)
+        self.assertEqual([f'clientinfo clid={client_id}' for client_id in range(8)],
+                         [result.result().parsed[0]['command'].strip() for result in results])
+
+    def test_failed_commands_do_not_shift_the_results(self):
+        connection = FakeQueryConnection(flood_commands=10)
+        batch = QueryBatch()
+        before = batch.clientinfo(clid=1)
+        move = batch.clientmove(clid=1, cid=99)
+        after = batch.clientinfo(clid=2)
+        batch.flush(connection)
+        self.assertFalse(before.failed)
+        self.assertTrue(move.failed)
+        with self.assertRaises(ts3.query.TS3QueryError):
+            move.result()
+        self.assertEqual('clientinfo clid=2', after.result().parsed[0]['command'].strip())
+
+    def test_empty_batch_sends_nothing(self):
+        connection = FakeQueryConnection(flood_commands=10)
+        QueryBatch().flush(connection)
+        self.assertEqual([], connection.chunks)
+
+
+if __name__ == '__main__':
+    unittest.main()
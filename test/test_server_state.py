@@ -0,0 +1,110 @@
+import unittest
+
+from tsviewer.server_state import ServerState
+
+CLIENTS = [{'clid': '1', 'cid': '1', 'client_nickname': 'Alice', 'client_unique_identifier': 'alice='},
+           {'clid': '2', 'cid': '2', 'client_nickname': 'Bob', 'client_unique_identifier': 'bob='}]
+
+CHANNELS = [{'cid': '1', 'pid': '0', 'channel_name': 'Lobby'},
+            {'cid': '2', 'pid': '0', 'channel_name': 'Games'},
+            {'cid': '3', 'pid': '2', 'channel_name': 'Chess'}]
+
+
+class ServerStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = ServerState()
+        self.state.reset(CLIENTS, CHANNELS)
+
+    def test_reset(self):
+        self.assertTrue(self.state.synchronized)
+        self.assertEqual('Alice', self.state.clients['1']['client_nickname'])
+        self.assertEqual('2', self.state.get_client_id_by_nickname('Bob'))
+        self.assertEqual('3', self.state.get_channel_id_by_name('Chess'))
+        self.assertEqual(['1', '2'], self.state.get_child_channel_ids())
+        self.assertEqual(['3'], self.state.get_child_channel_ids('2'))
+
+    def test_client_entered(self):
+        self.state.apply('notifycliententerview', [{'cfid': '0', 'ctid': '3', 'reasonid': '0', 'clid': '7',
+                                                    'client_nickname': 'Carol', 'client_flag_avatar': 'abc'}])
+        client = self.state.clients['7']
+        self.assertEqual('3', client['cid'])
+        self.assertEqual('0', client['client_idle_time'])
+        self.assertNotIn('ctid', client)
+        self.assertEqual('7', self.state.get_client_id_by_nickname('Carol'))
+
+    def test_client_moved(self):
+        self.state.apply('notifyclientmoved', [{'ctid': '3', 'reasonid': '0', 'clid': '1'}])
+        self.assertEqual('3', self.state.get_client_channel_id('1'))
+
+    def test_parameters_of_the_first_item_are_shared(self):
+        self.state.apply('notifyclientmoved', [{'ctid': '3', 'reasonid': '0', 'clid': '1'}, {'clid': '2'}])
+        self.assertEqual('3', self.state.get_client_channel_id('1'))
+        self.assertEqual('3', self.state.get_client_channel_id('2'))
+
+    def test_client_left(self):
+        self.state.apply('notifyclientleftview', [{'cfid': '1', 'ctid': '0', 'reasonid': '8', 'clid': '1'}])
+        self.assertNotIn('1', self.state.clients)
+        self.assertIsNone(self.state.get_client_channel_id('1'))
+        self.assertEqual(str(), self.state.get_client_id_by_nickname('Alice'))
+
+    def test_client_updated(self):
+        self.state.apply('notifyclientupdated', [{'clid': '1', 'client_nickname': 'Alicia'}])
+        self.assertEqual('Alicia', self.state.clients['1']['client_nickname'])
+        self.assertEqual(str(), self.state.get_client_id_by_nickname('Alice'))
+        self.assertEqual('1', self.state.get_client_id_by_nickname('Alicia'))
+
+    def test_reset_keeps_the_avatar_flag_of_the_same_client(self):
+        self.state.apply('notifyclientupdated', [{'clid': '1', 'client_flag_avatar': 'abc'},
+                                                 {'clid': '2', 'client_flag_avatar': 'def'}])
+        clients = [dict(CLIENTS[0]), dict(CLIENTS[1], client_unique_identifier='carol=')]
+        self.state.reset(clients, CHANNELS)
+        self.assertEqual('abc', self.state.clients['1']['client_flag_avatar'])
+        # The client id was reused by another client
+        self.assertNotIn('client_flag_avatar', self.state.clients['2'])
+
+    def test_channel_created(self):
+        self.state.apply('notifychannelcreated', [{'cid': '4', 'cpid': '3', 'channel_name': 'Go', 'invokerid': '1'}])
+        self.assertEqual('3', self.state.get_parent_channel_id('4'))
+        self.assertEqual(['4'], self.state.get_child_channel_ids('3'))
+        self.assertEqual('4', self.state.get_channel_id_by_name('Go'))
+        self.assertNotIn('invokerid', self.state.channels['4'])
+
+    def test_channel_edited(self):
+        self.state.apply('notifychanneledited', [{'cid': '3', 'reasonid': '10', 'channel_name': 'Checkers'}])
+        self.assertEqual(str(), self.state.get_channel_id_by_name('Chess'))
+        self.assertEqual('3', self.state.get_channel_id_by_name('Checkers'))
+
+    def test_channel_moved(self):
+        self.state.apply('notifychannelmoved', [{'cid': '3', 'cpid': '1', 'order': '0', 'reasonid': '1'}])
+        self.assertEqual('1', self.state.get_parent_channel_id('3'))
+        self.assertEqual(['3'], self.state.get_child_channel_ids('1'))
+        self.assertEqual([], self.state.get_child_channel_ids('2'))
+
+    def test_channel_deleted_with_sub_channels(self):
+        self.state.apply('notifychanneldeleted', [{'cid': '2', 'invokerid': '1'}])
+        self.assertEqual(['1'], self.state.get_channel_ids())
+        self.assertEqual(['1'], self.state.get_child_channel_ids())
+        self.assertEqual(str(), self.state.get_channel_id_by_name('Chess'))
+
+    def test_unknown_events_are_ignored(self):
+        version = self.state.version
+        self.state.apply('notifyunknown', [{'clid': '1'}])
+        self.assertEqual(version, self.state.version)
+
+    def test_listeners_and_version(self):
+        events = list()
+        self.state.add_listener(lambda event_name, data: events.append((event_name, data['clid'])))
+        version = self.state.version
+        self.state.apply('notifyclientmoved', [{'ctid': '1', 'clid': '2'}])
+        self.assertEqual([('notifyclientmoved', '2')], events)
+        self.assertEqual(self.state.version, self.state.wait_for_change(version, timeout=0))
+        self.assertGreater(self.state.version, version)
+
+    def test_invalidate(self):
+        self.state.invalidate()
+        self.assertFalse(self.state.synchronized)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,354 @@
+import asyncio
+import random
+import typing
+from collections import deque
+from imghdr import what
+from pathlib import Path
+
+import ts3
+from ts3.commands import TS3Commands
+from ts3.escape import TS3Escape
+from ts3.response import TS3QueryResponse, TS3Event
+
+from tsviewer.avatar_cache import AvatarCache
+from tsviewer.clientinfo import ClientInfo, ClientView
+from tsviewer.configuration import Configuration
+from tsviewer.logger import logger
+from tsviewer.path_utils import resolve_with_project_path
+from tsviewer.ts_viewer_client import USER_CLIENT_INFO_FIELDS
+from tsviewer.ts_viewer_utils import TeamspeakCommonKeys, SendMessageIdentifiers, CLIENT_LIST_OPTIONS, \
+    get_base64_hash_client_uid, _get_possible_file_names
+from tsviewer.user import User
+
+__all__ = ['AsyncQueryConnection', 'AsyncTsViewerClient']
+
+
+class AsyncQueryConnection(TS3Commands):
+    """
+    ServerQuery connection built on asyncio streams. All `ts3.commands.TS3Commands` methods are available and return
+    awaitables, e.g. `await connection.clientlist()`.
+    Commands are written as soon as they are issued and a reader task resolves the replies in order, so commands of
+    concurrent tasks are pipelined on the one connection instead of waiting for each other.
+    """
+
+    """
+    Buffer limit of the stream reader in bytes. Replies like `clientlist -uid` for hundreds of clients are one line,
+    that exceeds the default limit of 64 KiB. Longer lines are still read in parts
+    """
+    READ_LIMIT = 4 * 1024 * 1024
+
+    def __init__(self, configuration: Configuration = None) -> None:
+        """
+        :param configuration: `Configuration` object, `Configuration.get_instance()` is used if this is not set
+        """
+        self.configuration = configuration if configuration is not None else Configuration.get_instance()
+        self._reader: typing.Optional[asyncio.StreamReader] = None
+        self._writer: typing.Optional[asyncio.StreamWriter] = None
+        self._reader_task: typing.Optional[asyncio.Task] = None
+        self._pending: deque[asyncio.Future] = deque()
+        self.events: asyncio.Queue = asyncio.Queue()
+
+    async def open(self) -> None:
+        """
+        Connect and authorize against the configured Teamspeak server
+        """
+        self._reader, self._writer = await asyncio.open_connection(self.configuration.server_query_host,
+                                                                   self.configuration.server_query_port,
+                                                                   limit=AsyncQueryConnection.READ_LIMIT)
+        # Skip the two greeting lines
+        await self._reader.readuntil(b'\n\r')
+        await self._reader.readuntil(b'\n\r')
+        self._reader_task = asyncio.create_task(self._read_replies())
+        await self.login(client_login_name=self.configuration.server_query_user,
+                         client_login_password=self.configuration.server_query_password)
+        await self.use(sid=self.configuration.server_id)
+
+    async def close(self) -> None:
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        writer, self._writer = self._writer, None
+        if writer is None:
+            return None
+        writer.write(b'quit\n\r')
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError as error:
+            logger.debug(f'Closing the query connection failed: {error}')
+
+    def is_connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def send(self, command: str, common_parameters: dict = None, unique_parameters: list = None,
+                   options: list = None) -> TS3QueryResponse:
+        """
+        Write a query command and wait for its reply
+        :param command: The command name, e.g. `clientlist`
+        :param common_parameters: Parameters shared by all items
+        :param unique_parameters: A list of parameter dicts, separated by `|`
+        :param options: Command options without the leading `-`
+        :return: The reply
+        :raises ts3.query.TS3QueryError: If the server answered with an error
+        :raises ts3.query.TS3RecvError: If the connection is closed
+        """
+        if not self.is_connected():
+            raise ts3.query.TS3RecvError()
+        query_command = ' '.join([command,
+                                  TS3Escape.escape_parameters(common_parameters),
+                                  TS3Escape.escape_parameterlist(unique_parameters),
+                                  TS3Escape.escape_options(options)]) + '\n\r'
+        reply = asyncio.get_running_loop().create_future()
+        # Writing and queueing the future must not be interrupted, so the replies stay in order
+        self._pending.append(reply)
+        self._writer.write(query_command.encode())
+        await self._writer.drain()
+        return await reply
+
+    def _return_proxy(self, command: str, cparameters: dict, uparameters: list,
+                      options: list) -> typing.Awaitable[TS3QueryResponse]:
+        return self.send(command, cparameters, uparameters, options)
+
+    async def _read_line(self) -> bytes:
+        chunks = list()
+        while True:
+            try:
+                chunks.append(await self._reader.readuntil(b'\n\r'))
+                return b''.join(chunks)
+            except asyncio.LimitOverrunError as error:
+                # The line is longer than the buffer limit, so it is read in parts
+                chunks.append(await self._reader.readexactly(error.consumed))
+
+    async def _read_replies(self) -> None:
+        lines = list()
+        try:
+            while True:
+                line = await self._read_line()
+                if line.startswith(b'notify'):
+                    self.events.put_nowait(TS3Event(line))
+                    continue
+                lines.append(line)
+                if not line.startswith(b'error'):
+                    continue
+                response = TS3QueryResponse(b''.join(lines))
+                lines = list()
+                if not self._pending:
+                    logger.error(f'Dropping a query reply, that no command waits for: {response.error}')
+                    continue
+                reply = self._pending.popleft()
+                if reply.cancelled():
+                    continue
+                if response.error['id'] != '0':
+                    reply.set_exception(ts3.query.TS3QueryError(response))
+                else:
+                    reply.set_result(response)
+        except (asyncio.IncompleteReadError, OSError) as error:
+            logger.error(f'The query connection was closed: {error}')
+        finally:
+            self._writer = None
+            while self._pending:
+                reply = self._pending.popleft()
+                if not reply.done():
+                    reply.set_exception(ts3.query.TS3RecvError())
+
+
+class AsyncTsViewerClient(object):
+    """
+    The asyncio counterpart of `TsViewerClient`. It provides the same public API, but all methods are coroutines, so
+    independent operations (e.g. the `ftgetfilelist` commands of all channels or many avatar transfers) run
+    concurrently on one event loop.
+    """
+
+    def __init__(self, configuration: Configuration = None) -> None:
+        """
+        Call `connect` (or use `async with`) before issuing commands
+        :param configuration: `Configuration` object, `Configuration.get_instance()` is used if this is not set
+        """
+        self.configuration = configuration if configuration is not None else Configuration.get_instance()
+        self.connection = AsyncQueryConnection(self.configuration)
+        self.avatar_cache = AvatarCache()
+        self.channel_ids = list()
+        self._channel_message_lock = asyncio.Lock()
+
+    async def connect(self) -> None:
+        await self.connection.open()
+        self.channel_ids = await self.get_channel_id_list()
+
+    async def close(self) -> None:
+        await self.connection.close()
+
+    async def __aenter__(self) -> 'AsyncTsViewerClient':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.close()
+
+    async def get_client_info(self, clid: str) -> ClientInfo:
+        """
+        :param clid: Client ID
+        :return: A `Clientinfo` object containing detailed information about the client
+        """
+        response = await self.connection.clientinfo(clid=clid)
+        return ClientInfo(**response.parsed[0])
+
+    async def complete_client_info(self, clid: str, client_info: ClientInfo, names: list[str] = None) -> ClientInfo:
+        """
+        Fill the missing fields of a partial `ClientInfo`. See `TsViewerClient.complete_client_info`
+        """
+        if client_info.missing_fields(names):
+            response = await self.connection.clientinfo(clid=clid)
+            client_info.update(response.parsed[0])
+        return client_info
+
+    async def get_client_list(self) -> list[dict[str, str]]:
+        """
+        :return: The dict-representations of all clients besides the Query user client
+        """
+        clients = await self.connection.send('clientlist', options=CLIENT_LIST_OPTIONS)
+        return [client for client in clients.parsed
+                if client[TeamspeakCommonKeys.CLIENT_NICKNAME] != self.configuration.server_query_user]
+
+    async def get_client_id_list(self) -> list[str]:
+        return [client[TeamspeakCommonKeys.CLIENT_ID] for client in await self.get_client_list()]
+
+    async def get_channel_id_list(self) -> list[str]:
+        channels = await self.connection.channellist()
+        self.channel_ids = [channel[TeamspeakCommonKeys.CHANNEL_ID] for channel in channels.parsed]
+        return self.channel_ids
+
+    async def get_client_id_by_nickname(self, nickname: str) -> str:
+        clients = await self.get_client_list()
+        return next((client[TeamspeakCommonKeys.CLIENT_ID] for client in clients
+                     if client[TeamspeakCommonKeys.CLIENT_NICKNAME] == nickname), str())
+
+    async def get_channel_id_by_name(self, name: str) -> str:
+        channels = await self.connection.channellist()
+        return next((channel[TeamspeakCommonKeys.CHANNEL_ID] for channel in channels.parsed
+                     if channel[TeamspeakCommonKeys.CHANNEL_NAME] == name), str())
+
+    async def get_user_list(self) -> list[User]:
+        """
+        Get a list of all users. Missing client information and avatars are fetched concurrently for all clients
+        :return: A list of all users
+        """
+        clients = await self.get_client_list()
+        users = await asyncio.gather(*[self._build_user(client) for client in clients])
+        self.avatar_cache.save()
+        return list(users)
+
+    async def _build_user(self, client: dict[str, str]) -> User:
+        client_id = client[TeamspeakCommonKeys.CLIENT_ID]
+        client_info = ClientInfo.from_partial(client)
+        client_unique_identifier = client.get(TeamspeakCommonKeys.CLIENT_UNIQUE_IDENTIFIER)
+        if client_unique_identifier:
+            client_info.client_base64HashClientUID = get_base64_hash_client_uid(client_unique_identifier)
+        if client_info.client_flag_avatar is None and client_info.client_base64HashClientUID:
+            client_info.client_flag_avatar = self.avatar_cache.get_flag_avatar(
+                AvatarCache.key(self.configuration.server_id, client_info.client_base64HashClientUID))
+        await self.complete_client_info(client_id, client_info, USER_CLIENT_INFO_FIELDS)
+        client_view = ClientView.from_client_info(client_info)
+        avatar_file_name = await self._update_avatar(client_view)
+        return User(client_view, avatar_file_name=avatar_file_name, client_id=client_id)
+
+    async def get_file_list(self, channel_id: str) -> typing.Optional[TS3QueryResponse]:
+        """
+        :param channel_id: The target channel id
+        :return: The response or None if the channel has no files
+        """
+        try:
+            return await self.connection.ftgetfilelist(cid=channel_id, path='/')
+        except ts3.query.TS3QueryError as exception:
+            # We use debug here, because usually an exception is thrown when the channel is just empty
+            logger.debug(exception)
+            return None
+
+    async def get_files(self) -> dict[str, list[dict[str, str]]]:
+        """
+        List the files of all channels concurrently
+        :return: A mapping of channel IDs to their files. Channels without files are left out
+        """
+        channel_ids = await self.get_channel_id_list()
+        responses = await asyncio.gather(*[self.get_file_list(channel_id) for channel_id in channel_ids])
+        return {channel_id: response.parsed for channel_id, response in zip(channel_ids, responses)
+                if response is not None}
+
+    async def init_file_download(self, file_name: str, channel_id: str) -> TS3QueryResponse:
+        return await self.connection.ftinitdownload(clientftfid=random.randint(1, 64000), name=f'/{file_name}',
+                                                    cid=channel_id, seekpos=0)
+
+    async def download_avatar(self, file_name: str) -> typing.Optional[str]:
+        """
+        Download an avatar to `static/avatars` over an asyncio stream
+        :param file_name: The avatar file name, e.g. `avatar_<client_base64HashClientUID>`
+        :return: The file path of the created file or `None`
+        """
+        try:
+            response = (await self.init_file_download(file_name, '0')).parsed[0]
+            size = int(response['size'])
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.configuration.server_query_host, int(response.get('port', 30033))),
+                self.configuration.file_transfer_timeout)
+            try:
+                writer.write(response['ftkey'].encode())
+                image = await asyncio.wait_for(reader.readexactly(size), self.configuration.file_transfer_timeout)
+            finally:
+                writer.close()
+        except (ts3.TS3Error, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as exception:
+            logger.error(f'Due to the exception {exception} the download of file {file_name} did not succeed')
+            return None
+        file_path = f'static/avatars/{file_name}.{what(None, h=image)}'
+        with Path(file_path).open('wb') as avatar_file:
+            avatar_file.write(image)
+        return file_path
+
+    async def move(self, client_id: str, channel_id: str) -> None:
+        await self.connection.clientmove(clid=client_id, cid=channel_id)
+
+    async def move_around(self) -> None:
+        """
+        Move all clients into random channels. All moves are issued concurrently
+        """
+        results = await asyncio.gather(*[self.move(client_id, random.choice(self.channel_ids))
+                                         for client_id in await self.get_client_id_list()], return_exceptions=True)
+        for result in results:
+            if isinstance(result, ts3.TS3Error):
+                logger.error(f'Clientmove failed: {result}')
+
+    async def who_am_i(self) -> TS3QueryResponse:
+        return await self.connection.whoami()
+
+    async def send_message_to_client(self, message: str, client_id: str) -> None:
+        await self.connection.sendtextmessage(targetmode=SendMessageIdentifiers.TO_CLIENT, target=client_id,
+                                              msg=message)
+
+    async def send_message_to_channel(self, message: str, channel_id: str) -> None:
+        # The query client is moved into the channel first, so concurrent channel messages must not interleave
+        async with self._channel_message_lock:
+            who_am_i = (await self.who_am_i()).parsed
+            await self.connection.clientmove(clid=who_am_i[0]['client_id'], cid=channel_id)
+            await self.connection.sendtextmessage(targetmode=SendMessageIdentifiers.TO_CHANNEL, msg=message,
+                                                  target='')
+
+    async def send_message_to_server(self, message: str) -> None:
+        await self.connection.sendtextmessage(targetmode=SendMessageIdentifiers.TO_SERVER, msg=message, target='')
+
+    async def poke_client(self, message: typing.Optional[str], client_id: str) -> None:
+        await self.connection.clientpoke(msg=message if message is not None else '', clid=client_id)
+
+    async def _update_avatar(self, client: typing.Union[ClientInfo, ClientView]) -> typing.Optional[str]:
+        if isinstance(client, ClientInfo):
+            client = ClientView.from_client_info(client)
+        client_base64_hash_uid = client.base64_hash_client_uid
+        if client.flag_avatar == str():
+            return None
+        cache_key = AvatarCache.key(self.configuration.server_id, client_base64_hash_uid)
+        hit, avatar_file_name = self.avatar_cache.lookup(cache_key, client.flag_avatar)
+        if hit:
+            return avatar_file_name
+        file_name = f'avatar_{client_base64_hash_uid}'
+        await self.download_avatar(file_name)
+        for possible_path in _get_possible_file_names(file_name):
+            if resolve_with_project_path('static/avatars/' + possible_path).is_file():
+                avatar_file_name = 'avatars/' + possible_path
+        self.avatar_cache.store(cache_key, client.flag_avatar, avatar_file_name)
+        return avatar_file_name
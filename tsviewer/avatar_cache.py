@@ -0,0 +1,105 @@
+import typing
+from json import load, dump, JSONDecodeError
+from threading import Lock
+
+from tsviewer.configuration import Configuration
+from tsviewer.logger import logger
+from tsviewer.path_utils import resolve_with_project_path
+
+__all__ = ['AvatarCache']
+
+
+class AvatarCache(object):
+    """
+    Persistent cache for the avatar files in `static/avatars`. Each entry is keyed by the virtual server and the
+    `client_base64HashClientUID` of a client, see `key`, and stores the `client_flag_avatar` hash of the avatar that was
+    downloaded. Teamspeak changes that hash whenever a client changes its avatar, so the avatar only has to be
+    transferred again when the hash changed. The same identity can have different avatars on different virtual servers,
+    so one cache can be shared by all servers.
+    """
+
+    def __init__(self, path: str = None) -> None:
+        """
+        :param path: Path to the cache file. Defaults to `Configuration.avatar_cache_path`
+        """
+        self.path = resolve_with_project_path(path if path is not None
+                                              else Configuration.get_instance().avatar_cache_path)
+        self._lock = Lock()
+        self._dirty = False
+        self._entries: dict[str, dict[str, typing.Optional[str]]] = self._load()
+
+    @staticmethod
+    def key(server_id: typing.Union[int, str], client_base64_hash_uid: str) -> str:
+        """
+        :param server_id: The virtual server id
+        :param client_base64_hash_uid: The `client_base64HashClientUID` of the client
+        :return: The cache key of the avatar of that client on that server
+        """
+        return f'{server_id}/{client_base64_hash_uid}'
+
+    def lookup(self, key: str,
+               flag_avatar: typing.Optional[str]) -> tuple[bool, typing.Optional[str]]:
+        """
+        Look up the avatar of a client
+        :param key: The cache key of the client, see `key`
+        :param flag_avatar: The current `client_flag_avatar` of the client. If this is `None`, the hash is unknown and
+                            the lookup is a miss, so a changed avatar is never mistaken for the cached one
+        :return: A tuple of a flag, that is True on a cache hit, and the avatar file name relative to `static`. The
+                 file name is `None` if the client has no avatar
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        if flag_avatar is None or entry.get('flag_avatar') != flag_avatar:
+            return False, None
+        file_name = entry.get('file_name')
+        if file_name is not None and not resolve_with_project_path('static/' + file_name).is_file():
+            return False, None
+        return True, file_name
+
+    def get_flag_avatar(self, key: str) -> typing.Optional[str]:
+        """
+        :param key: The cache key of the client, see `key`
+        :return: The `client_flag_avatar` of the cached avatar or `None`, if the client is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry.get('flag_avatar') if entry is not None else None
+
+    def store(self, key: str, flag_avatar: typing.Optional[str],
+              file_name: typing.Optional[str]) -> None:
+        """
+        Remember the avatar of a client. Call `save` to persist the cache
+        :param key: The cache key of the client, see `key`
+        :param flag_avatar: The `client_flag_avatar` of the downloaded avatar
+        :param file_name: The avatar file name relative to `static` or `None`, if the client has no avatar
+        """
+        with self._lock:
+            self._entries[key] = {'flag_avatar': flag_avatar, 'file_name': file_name}
+            self._dirty = True
+
+    def save(self) -> None:
+        """
+        Write the cache file, if any entry changed since the last save
+        """
+        with self._lock:
+            if not self._dirty:
+                return None
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with self.path.open('w') as cache_file:
+                    dump(self._entries, cache_file)
+                self._dirty = False
+            except OSError as exception:
+                logger.error(f'Could not write the avatar cache to {self.path}: {exception}')
+
+    def _load(self) -> dict[str, dict[str, typing.Optional[str]]]:
+        if not self.path.is_file():
+            return dict()
+        try:
+            with self.path.open('r') as cache_file:
+                return load(cache_file)
+        except (OSError, JSONDecodeError) as exception:
+            logger.error(f'Could not read the avatar cache from {self.path}, starting with an empty cache: {exception}')
+            return dict()
@@ -1,12 +1,21 @@
-# Beware: This class ignores sub-folders within the channels
-from typing import Optional
+# Beware: Apart from `iter_files` and `get_file_page`, this class ignores sub-folders within the channels
+import posixpath
+import time
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from threading import Lock
+from typing import Optional, Iterator
+
+import ts3
 
 from tsviewer.configuration import Configuration
 from tsviewer.ts_viewer_client import TsViewerClient
 from tsviewer.logger import logger
 from urllib.parse import quote
 
-from tsviewer.file_transfers import download_file
+from tsviewer.file_transfers import download_file, TransferReport
+from tsviewer.upload_cleanup import UploadCleanupJournal, CleanupReport
 
 
 class ChannelUploads(object):
@@ -22,9 +31,30 @@ class ChannelUploads(object):
     A collection of all files that were found on the server
     """
     files: Optional[list]
+    """
+    Incremented whenever `get_files` finds a different set of files
+    """
+    version: int
 
     AVATAR_CHANNEL_ID = '0'
 
+    """
+    Sort keys for `iter_files` and `get_file_page`
+    """
+    FILE_SORT_KEYS = {'name': lambda file: file.get('name', '').lower(),
+                      'size': lambda file: int(file.get('size') or 0),
+                      'datetime': lambda file: int(file.get('datetime') or 0)}
+
+    """
+    The `type` of directories in a `FTGETFILELIST` response
+    """
+    DIRECTORY_TYPE = '0'
+
+    """
+    Maximum size of a channel description in bytes, that the Teamspeak server accepts
+    """
+    DESCRIPTION_SIZE_LIMIT = 8192
+
     def __init__(self, client: 'TsViewerClient') -> None:
         """
         `ChannelUploads` requires a designated upload channel for it`s functionalities.
@@ -34,20 +64,36 @@ class ChannelUploads(object):
         self.client = client
         self.files = None
         self.channel_to_file_map = dict()
+        self.version = 0
+        self._files_updated_at = 0.0
+        self._files_lock = Lock()
+        self._directories: dict[tuple[str, str], tuple[float, list[dict[str, str]]]] = dict()
+        self.cleanup_journal = UploadCleanupJournal()
+        self._server_uid: Optional[str] = None
+        self._description_hash: Optional[str] = None
 
-    def clean_up(self) -> None:
+    def clean_up(self) -> CleanupReport:
         """
-        Moves all files that were uploaded to the server into the designated upload-channel
+        Moves all files that were uploaded to the server into the designated upload-channel. Files that an earlier
+        run already processed are skipped, see `UploadCleanupJournal`, and all moves are issued as one batch.
+        :return: A summary of the moved and failed files
         """
         self.get_files()
-        self._move_files_to_upload_channel()
+        report = self._move_files_to_upload_channel()
+        self.get_files()
         self.update_upload_channel_description()
+        return report
 
-    def update_upload_channel_description(self) -> None:
+    def update_upload_channel_description(self) -> bool:
         """
-        Create a new description string for the upload channel that lists and links all files located in that channel
+        Create a new description string for the upload channel that lists and links all files located in that channel.
+        The channel is only edited, if the description differs from the one that was published last. If the links
+        exceed `ChannelUploads.DESCRIPTION_SIZE_LIMIT`, the description lists as many files as fit, in the order of the
+        file listing, followed by the number of files that were left out.
+        :return: True if the channel description was edited
         """
-        server_uid = self.client.who_am_i()[0]['virtualserver_unique_identifier']
+        if self._server_uid is None:
+            self._server_uid = self.client.who_am_i()[0]['virtualserver_unique_identifier']
         upload_channel_files = self._get_files_from_upload_channel()
         configuration = Configuration.get_instance()
         tag_list = list()
@@ -55,23 +101,139 @@ class ChannelUploads(object):
         for file in upload_channel_files:
             tag = ChannelUploads._format_url_as_bb_code_link_for_channel_description(configuration.server_query_host,
                                                                                      voice_port,
-                                                                                     server_uid,
+                                                                                     self._server_uid,
                                                                                      self.upload_channel_id,
                                                                                      file['name'],
                                                                                      file['size'],
                                                                                      file['datetime'])
             tag_list.append(tag)
-        self.client.edit_channel_description(configuration.upload_channel_id, '\n\n'.join(tag_list))
+        description = ChannelUploads._join_description_tags(tag_list, ChannelUploads.DESCRIPTION_SIZE_LIMIT)
+        description_hash = sha1(description.encode()).hexdigest()
+        if description_hash == self._description_hash:
+            logger.debug('The upload channel description did not change')
+            return False
+        self.client.edit_channel_description(configuration.upload_channel_id, description)
+        self._description_hash = description_hash
+        return True
+
+    @staticmethod
+    def _join_description_tags(tags: list[str], size_limit: int) -> str:
+        """
+        Join the tags with blank lines. Tags that would exceed the size limit are left out and replaced by a note
+        :param tags: The BB-Code tags
+        :param size_limit: Maximum size of the description in bytes
+        :return: The description
+        """
+        separator = '\n\n'
+        description = separator.join(tags)
+        if len(description.encode()) <= size_limit:
+            return description
+        included = list()
+        size = 0
+        for index, tag in enumerate(tags):
+            # Reserve enough space for the note about the remaining files
+            note = separator + ChannelUploads._format_omitted_files_note(len(tags) - index)
+            tag_size = len(tag.encode()) + (len(separator) if included else 0)
+            if size + tag_size + len(note.encode()) > size_limit:
+                return separator.join(included) + (note if included else note[len(separator):])
+            included.append(tag)
+            size += tag_size
+        return separator.join(included)
+
+    @staticmethod
+    def _format_omitted_files_note(count: int) -> str:
+        return f'[I]... and {count} more files[/I]'
 
-    def get_files(self) -> list[list[dict[str: str]]]:
+    def get_files(self, refresh: bool = False, max_connections: int = None) -> list[list[dict[str: str]]]:
         """
-        Get a list of all files and updates the attribute `files` and `channel_to_file_map`
+        Get a list of all files and updates the attribute `files` and `channel_to_file_map`. The listing is cached for
+        `Configuration.file_list_cache_ttl` seconds or until `invalidate_files` is called.
+        :param refresh: If True, the cached listing is ignored
+        :param max_connections: Maximum number of pooled connections the listing may use, see
+                                `TsViewerClient.get_file_lists`
         :return: list of file paths
         """
+        ttl = Configuration.get_instance().file_list_cache_ttl
+        with self._files_lock:
+            # Concurrent requests wait for one refresh instead of starting their own
+            if refresh or self.files is None or time.monotonic() - self._files_updated_at >= ttl:
+                self._update_files(max_connections)
+            return self.files
+
+    def invalidate_files(self) -> None:
+        """
+        Drop the cached file listing, e.g. after files were moved or renamed
+        """
+        with self._files_lock:
+            self._files_updated_at = 0.0
+            self._directories.clear()
+
+    def iter_files(self, channel_id: str, path: str = '/', recursive: bool = True, sort: str = 'name',
+                   descending: bool = False) -> Iterator[dict[str, str]]:
+        """
+        Lazily walk the files and directories of a channel. A directory is only listed when the iteration reaches it,
+        so taking the first few entries does not list the whole channel. Every directory is yielded before its content.
+        The entries of each directory are sorted, the order across directories is the traversal order.
+        :param channel_id: The channel id
+        :param path: The directory to start at
+        :param recursive: If False, only the entries of `path` are yielded
+        :param sort: One of `ChannelUploads.FILE_SORT_KEYS`
+        :param descending: Reverse the sort order
+        :return: The `FTGETFILELIST` entries, including `cid` and `path`
+        :raises ValueError: If `sort` is unknown
+        """
+        if sort not in ChannelUploads.FILE_SORT_KEYS:
+            raise ValueError(f'Unknown sort key {sort}, expected one of {", ".join(ChannelUploads.FILE_SORT_KEYS)}')
+        entries = sorted(self._get_directory(channel_id, path), key=ChannelUploads.FILE_SORT_KEYS[sort],
+                         reverse=descending)
+        for entry in entries:
+            yield entry
+            if recursive and entry.get('type') == ChannelUploads.DIRECTORY_TYPE:
+                yield from self.iter_files(channel_id, posixpath.join(path, entry['name']), recursive, sort,
+                                           descending)
+
+    def get_file_page(self, channel_id: str, path: str = '/', page: int = 1, page_size: int = 50,
+                      recursive: bool = True, sort: str = 'name',
+                      descending: bool = False) -> tuple[list[dict[str, str]], bool]:
+        """
+        Get one page of `iter_files`. Only the directories up to the end of the page are listed.
+        :param channel_id: The channel id
+        :param path: The directory to start at
+        :param page: The page number, starting at 1
+        :param page_size: Number of entries per page
+        :param recursive: If False, only the entries of `path` are returned
+        :param sort: One of `ChannelUploads.FILE_SORT_KEYS`
+        :param descending: Reverse the sort order
+        :return: A tuple of the entries and a flag, that is True if there is a next page
+        :raises ValueError: If `sort` is unknown
+        """
+        page, page_size = max(1, page), max(1, page_size)
+        start = (page - 1) * page_size
+        # One additional entry tells whether there is a next page
+        entries = list(islice(self.iter_files(channel_id, path, recursive, sort, descending), start,
+                              start + page_size + 1))
+        return entries[:page_size], len(entries) > page_size
+
+    def _get_directory(self, channel_id: str, path: str) -> list[dict[str, str]]:
+        # Directory listings share the TTL of the file listing, so paging through a channel does not list the same
+        # directories again for every page
+        ttl = Configuration.get_instance().file_list_cache_ttl
+        with self._files_lock:
+            updated_at, entries = self._directories.get((channel_id, path), (0.0, None))
+        if entries is not None and time.monotonic() - updated_at < ttl:
+            return entries
+        response = self.client.get_file_list(channel_id, path)
+        entries = [{**entry, 'cid': channel_id, 'path': path} for entry in response.parsed] \
+            if response is not None else list()
+        with self._files_lock:
+            self._directories[(channel_id, path)] = (time.monotonic(), entries)
+        return entries
+
+    def _update_files(self, max_connections: int = None) -> None:
         files = list()
         channel_to_file_map = dict()
-        for cid in self.client.get_channel_id_list():
-            raw_files = self.client.get_file_list(cid)
+        file_lists = self.client.get_file_lists(self.client.get_channel_id_list(), max_connections)
+        for cid, raw_files in file_lists.items():
             if raw_files is not None:
                 raw_files = raw_files.parsed
             else:
@@ -81,45 +243,125 @@ class ChannelUploads(object):
             for file_list in raw_files:
                 channel_to_file_map[cid].append(file_list)
 
+        if self.files is None or channel_to_file_map != self.channel_to_file_map:
+            self.version += 1
         self.files = files
         self.channel_to_file_map = channel_to_file_map
-        return files
+        self._files_updated_at = time.monotonic()
 
-    def download_avatars_to_static_folder(self) -> None:
+    def download_avatars_to_static_folder(self, concurrency: int = None, retries: int = None) -> TransferReport:
         """
-        Downloads all avatars to the static folder
+        Downloads all avatars to the static folder. The downloads run in a bounded worker pool and every failed
+        download is retried.
+        :param concurrency: Maximum number of concurrent transfers.
+                            Defaults to `Configuration.file_transfer_concurrency`
+        :param retries: Retries per file. Defaults to `Configuration.file_transfer_retries`
+        :return: A summary of the transfers
         """
-        raw_files = self.client.get_file_list(ChannelUploads.AVATAR_CHANNEL_ID).parsed
-        downloaded_files = 0
+        configuration = Configuration.get_instance()
+        if concurrency is None:
+            concurrency = configuration.file_transfer_concurrency
+        if retries is None:
+            retries = configuration.file_transfer_retries
+        response = self.client.get_file_list(ChannelUploads.AVATAR_CHANNEL_ID)
+        raw_files = response.parsed if response is not None else list()
+        file_names = [file['name'] for file in raw_files if file.get('name') != 'icons']
 
-        for file in raw_files:
-            if file.get('name') == 'icons':
-                continue
-            downloaded_files += self.download_avatar(file['name'])
+        report = TransferReport()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='tsviewer-avatar') as executor:
+            futures = {executor.submit(self._download_avatar_with_retries, file_name, retries): file_name
+                       for file_name in file_names}
+            for future in as_completed(futures):
+                file_path, attempts = future.result()
+                if file_path is None:
+                    report.failed.append(futures[future])
+                else:
+                    report.succeeded.append(file_path)
+                report.attempts += attempts
 
-        logger.info(f'Downloaded {downloaded_files} out of {len(raw_files) - 1} requested avatar images')
+        logger.info(f'Downloaded {len(report.succeeded)} out of {len(file_names)} requested avatar images '
+                    f'with {report.attempts} attempts')
+        if report.failed:
+            logger.error(f'Could not download the avatars {", ".join(report.failed)}')
+        return report
 
-    def download_avatar(self, file_name: str) -> Optional[str]:
+    def _download_avatar_with_retries(self, file_name: str, retries: int) -> tuple[Optional[str], int]:
+        attempts = 0
+        file_path = None
+        while file_path is None and attempts <= retries:
+            attempts += 1
+            try:
+                file_path = self.download_avatar(file_name)
+            except (ts3.TS3Error, OSError) as error:
+                logger.error(f'FTINITDOWNLOAD for {file_name} failed: {error}')
+        return file_path, attempts
+
+    def download_avatar(self, file_name: str, local_file_name: str = None) -> Optional[str]:
         """
         Download an avatar specified by the file name / client uid
         :param file_name: The file name / client uid
+        :param local_file_name: The file name in `static/avatars` without extension. Defaults to `file_name`
         :return: The response of `download_file`
         """
         download_response = self.client.init_file_download(file_name, ChannelUploads.AVATAR_CHANNEL_ID)
-        return download_file(download_response, file_name)
+        return download_file(download_response, local_file_name if local_file_name is not None else file_name)
 
-    def _get_files_from_channel(self, channel_id: str) -> list[str]:
-        return self.channel_to_file_map.get(channel_id)
+    def _get_files_from_channel(self, channel_id: str) -> list[dict[str: str]]:
+        return self.channel_to_file_map.get(channel_id, list())
 
     def _get_files_from_upload_channel(self) -> list[dict[str: str]]:
         return self._get_files_from_channel(self.upload_channel_id)
 
-    def _move_files_to_upload_channel(self) -> None:
+    def _move_files_to_upload_channel(self) -> CleanupReport:
+        max_attempts = Configuration.get_instance().upload_cleanup_max_attempts
+        report = CleanupReport()
+        taken_names = {file['name'] for file in self._get_files_from_upload_channel()}
+        listed_keys = list()
+        sources = list()
+        moves = list()
         for cid, files in self.channel_to_file_map.items():
             if cid == self.upload_channel_id:
                 continue
             for file in files:
-                self.client.move_file(cid, self.upload_channel_id, file['name'])
+                key = UploadCleanupJournal.key(cid, file['name'])
+                listed_keys.append(key)
+                if not self.cleanup_journal.should_move(cid, file, max_attempts):
+                    report.skipped.append(key)
+                    continue
+                new_file_name = ChannelUploads._get_free_file_name(file['name'], taken_names)
+                taken_names.add(new_file_name)
+                sources.append((cid, file))
+                moves.append((cid, self.upload_channel_id, file['name'], new_file_name))
+
+        if moves:
+            for (cid, file), error in zip(sources, self.client.move_files(moves)):
+                self.cleanup_journal.record(cid, file, error)
+                key = UploadCleanupJournal.key(cid, file['name'])
+                if error is None:
+                    report.moved.append(key)
+                else:
+                    report.failed[key] = error
+            self.invalidate_files()
+        self.cleanup_journal.prune(listed_keys)
+        self.cleanup_journal.save()
+        logger.info(f'Upload channel cleanup moved {len(report.moved)} files, {len(report.failed)} failed and '
+                    f'{len(report.skipped)} were skipped')
+        return report
+
+    @staticmethod
+    def _get_free_file_name(file_name: str, taken_names: set[str]) -> str:
+        """
+        Append a counter to the file name, if a file with that name already exists in the target channel
+        :param file_name: The file name
+        :param taken_names: The file names in the target channel
+        :return: A file name that is not taken
+        """
+        stem, extension = posixpath.splitext(file_name)
+        new_file_name, counter = file_name, 1
+        while new_file_name in taken_names:
+            new_file_name = f'{stem} ({counter}){extension}'
+            counter += 1
+        return new_file_name
 
     @staticmethod
     def _format_url_as_bb_code_link_for_channel_description(host: str, port: str, server_uid: str, channel_id: str,
@@ -0,0 +1,250 @@
+import random
+import typing
+from dataclasses import dataclass, field
+from queue import Queue, Empty
+from threading import Thread, Lock, Event
+from uuid import uuid4
+
+from tsviewer.logger import logger
+from tsviewer.ts_viewer_client import TsViewerClient
+from tsviewer.ts_viewer_utils import TeamspeakCommonKeys
+
+__all__ = ['ClientRuleEngine', 'KeepAwayRule', 'FollowRule', 'RuleConflictException']
+
+"""
+Events that may break a rule
+"""
+_RULE_EVENTS = ['notifycliententerview', 'notifyclientmoved']
+
+
+class RuleConflictException(Exception):
+    """
+    Named exception that is raised when a new rule contradicts the existing rules, e.g. a follow rule, that closes a
+    cycle
+    """
+    pass
+
+
+def _create_rule_id() -> str:
+    return uuid4().hex[:8]
+
+
+@dataclass
+class KeepAwayRule:
+    """
+    Keep a client out of a channel
+    """
+    client_id: str
+    channel_id: str
+    rule_id: str = field(default_factory=_create_rule_id)
+
+    def to_dict(self) -> dict[str, str]:
+        return {'id': self.rule_id, 'type': 'keep_away', 'clid': self.client_id, 'cid': self.channel_id}
+
+
+@dataclass
+class FollowRule:
+    """
+    Keep a client in the channel of another client
+    """
+    follower_client_id: str
+    chased_client_id: str
+    rule_id: str = field(default_factory=_create_rule_id)
+
+    def to_dict(self) -> dict[str, str]:
+        return {'id': self.rule_id, 'type': 'follow', 'clid': self.follower_client_id,
+                'target_clid': self.chased_client_id}
+
+
+class ClientRuleEngine(Thread):
+    """
+    Background thread, that enforces standing `KeepAwayRule` and `FollowRule` rules. Rules are evaluated against the
+    `ServerState` of the client and only for clients, that entered or moved and are part of a rule, so idle rules don't
+    issue any query command. All moves of one evaluation are sent with `TsViewerClient.move_clients`.
+    Follow rules must not form a cycle, and a move the engine issued itself does not trigger the rules of the moved
+    client again, so the clients don't bounce between channels.
+    Client ids are only valid for one connection, so the rules of a client are removed when it leaves the server.
+    The rules need a synchronized `ServerState`, i.e. `Configuration.server_state_enabled`.
+    """
+
+    def __init__(self, client: TsViewerClient) -> None:
+        """
+        :param client: The `TsViewerClient` of the virtual server, whose state is watched and whose clients are moved
+        """
+        super().__init__(name=f'tsviewer-client-rules-{client.server_id}', daemon=True)
+        self.client = client
+        self.state = client.state
+        self._lock = Lock()
+        self._rules: dict[str, typing.Union[KeepAwayRule, FollowRule]] = dict()
+        self._keep_away_rules: dict[str, list[KeepAwayRule]] = dict()
+        self._follow_rules: dict[str, FollowRule] = dict()
+        self._followers: dict[str, list[FollowRule]] = dict()
+        # Target channel ids of the moves the engine issued and whose event has not arrived yet
+        self._own_moves: dict[str, str] = dict()
+        # Ids of clients that have to be checked against their rules
+        self._pending: Queue = Queue()
+        self._stopped = Event()
+        self.state.add_listener(self._on_event)
+
+    def add_keep_away(self, client_id: str, channel_id: str) -> KeepAwayRule:
+        """
+        :param client_id: The client, that must not be in the channel
+        :param channel_id: The channel
+        :return: The new rule
+        """
+        rule = KeepAwayRule(str(client_id), str(channel_id))
+        with self._lock:
+            self._rules[rule.rule_id] = rule
+            self._keep_away_rules.setdefault(rule.client_id, list()).append(rule)
+        self._pending.put(rule.client_id)
+        return rule
+
+    def add_follow(self, follower_client_id: str, chased_client_id: str) -> FollowRule:
+        """
+        A client only follows one other client, so an older follow rule of the follower is replaced
+        :param follower_client_id: The client, that is moved
+        :param chased_client_id: The client, whose channel is followed
+        :return: The new rule
+        :raises ValueError: If a client should follow itself
+        :raises RuleConflictException: If the chased client already follows the follower, directly or through others
+        """
+        rule = FollowRule(str(follower_client_id), str(chased_client_id))
+        if rule.follower_client_id == rule.chased_client_id:
+            raise ValueError('A client cannot follow itself')
+        with self._lock:
+            if self._leads_to(rule.chased_client_id, rule.follower_client_id):
+                raise RuleConflictException(f'clid={rule.chased_client_id} already follows '
+                                            f'clid={rule.follower_client_id}')
+            previous = self._follow_rules.get(rule.follower_client_id)
+            if previous is not None:
+                self._remove(previous.rule_id)
+            self._rules[rule.rule_id] = rule
+            self._follow_rules[rule.follower_client_id] = rule
+            self._followers.setdefault(rule.chased_client_id, list()).append(rule)
+        self._pending.put(rule.follower_client_id)
+        return rule
+
+    def remove(self, rule_id: str) -> bool:
+        """
+        :param rule_id: The id of the rule
+        :return: True if the rule existed
+        """
+        with self._lock:
+            return self._remove(rule_id)
+
+    def get_rules(self) -> list[typing.Union[KeepAwayRule, FollowRule]]:
+        """
+        :return: All rules
+        """
+        with self._lock:
+            return list(self._rules.values())
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                client_ids = {self._pending.get(timeout=1)}
+            except Empty:
+                continue
+            # Clients that moved together are enforced together
+            while not self._pending.empty():
+                client_ids.add(self._pending.get_nowait())
+            try:
+                self._enforce(client_ids)
+            except Exception as exception:
+                logger.error(f'Enforcing the client rules failed: {exception}')
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _on_event(self, event_name: str, data: dict[str, str]) -> None:
+        # Called while the `ServerState` is locked, so the work is left to the rule thread
+        client_id = data.get(TeamspeakCommonKeys.CLIENT_ID)
+        with self._lock:
+            if client_id not in self._keep_away_rules and client_id not in self._follow_rules \
+                    and client_id not in self._followers:
+                return None
+            # Any later move of the client replaces the pending move of the engine
+            own_move_channel_id = self._own_moves.pop(client_id, None)
+            if event_name == 'notifyclientleftview':
+                for rule in [rule for rule in self._rules.values() if client_id in ClientRuleEngine._clients_of(rule)]:
+                    self._remove(rule.rule_id)
+            elif event_name == 'notifyclientmoved' and own_move_channel_id == data.get('ctid'):
+                # The engine moved this client itself, so only its followers have to react
+                for rule in self._followers.get(client_id, list()):
+                    self._pending.put(rule.follower_client_id)
+            elif event_name in _RULE_EVENTS:
+                self._pending.put(client_id)
+
+    def _enforce(self, client_ids: set[str]) -> None:
+        moves: dict[str, str] = dict()
+        for client_id in client_ids:
+            channel_id = self.state.get_client_channel_id(client_id)
+            if channel_id is None:
+                continue
+            with self._lock:
+                forbidden_channel_ids = self._get_forbidden_channel_ids(client_id)
+                follow_rule = self._follow_rules.get(client_id)
+                followers = [rule.follower_client_id for rule in self._followers.get(client_id, list())]
+            if channel_id in forbidden_channel_ids:
+                free_channel_ids = [free_channel_id for free_channel_id in self.state.get_channel_ids()
+                                    if free_channel_id not in forbidden_channel_ids]
+                if free_channel_ids:
+                    moves[client_id] = random.choice(free_channel_ids)
+                # The followers follow, when the move of this client is announced
+                continue
+            if follow_rule is not None:
+                chased_channel_id = self.state.get_client_channel_id(follow_rule.chased_client_id)
+                if chased_channel_id not in [None, channel_id] and chased_channel_id not in forbidden_channel_ids:
+                    moves[client_id] = chased_channel_id
+            for follower_client_id in followers:
+                with self._lock:
+                    forbidden = channel_id in self._get_forbidden_channel_ids(follower_client_id)
+                if not forbidden and follower_client_id not in moves:
+                    moves[follower_client_id] = channel_id
+        if not moves:
+            return None
+        with self._lock:
+            # The events of the moves may arrive before `move_clients` returns
+            self._own_moves.update(moves)
+        for client_id, error in self.client.move_clients(list(moves.items())).items():
+            if error is not None:
+                logger.info(f'Could not enforce the rules of clid={client_id}: {error}')
+                with self._lock:
+                    self._own_moves.pop(client_id, None)
+
+    def _leads_to(self, client_id: str, target_client_id: str) -> bool:
+        # Follow rules form chains, because a client follows at most one other client
+        while client_id is not None:
+            if client_id == target_client_id:
+                return True
+            follow_rule = self._follow_rules.get(client_id)
+            client_id = follow_rule.chased_client_id if follow_rule is not None else None
+        return False
+
+    def _get_forbidden_channel_ids(self, client_id: str) -> list[str]:
+        return [rule.channel_id for rule in self._keep_away_rules.get(client_id, list())]
+
+    def _remove(self, rule_id: str) -> bool:
+        rule = self._rules.pop(rule_id, None)
+        if rule is None:
+            return False
+        if isinstance(rule, KeepAwayRule):
+            ClientRuleEngine._remove_from_index(self._keep_away_rules, rule.client_id, rule)
+        else:
+            self._follow_rules.pop(rule.follower_client_id, None)
+            ClientRuleEngine._remove_from_index(self._followers, rule.chased_client_id, rule)
+        return True
+
+    @staticmethod
+    def _remove_from_index(index: dict[str, list], key: str, rule: typing.Union[KeepAwayRule, FollowRule]) -> None:
+        rules = index.get(key, list())
+        if rule in rules:
+            rules.remove(rule)
+        if not rules:
+            index.pop(key, None)
+
+    @staticmethod
+    def _clients_of(rule: typing.Union[KeepAwayRule, FollowRule]) -> list[str]:
+        if isinstance(rule, KeepAwayRule):
+            return [rule.client_id]
+        return [rule.follower_client_id, rule.chased_client_id]
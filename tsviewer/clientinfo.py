@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+import typing
+from dataclasses import dataclass, fields
 from json import load
 from tsviewer.path_utils import resolve_with_project_path
 
@@ -71,6 +72,92 @@ class ClientInfo:
     connection_connected_time: str
     connection_client_ip: str
 
+    @staticmethod
+    def from_partial(source: dict[str, str]) -> 'ClientInfo':
+        """
+        Build a `ClientInfo` from a response that only carries a subset of the `clientinfo` fields, e.g. an entry of
+        the `clientlist` command. Missing fields are set to `None` and unknown keys are ignored.
+        :param source: A dict-representation of a single client as returned by a `ts3.query.TS3Connection` command
+        :return: A `ClientInfo` object, that may have `None` fields
+        """
+        return ClientInfo(**{field.name: source.get(field.name) for field in fields(ClientInfo)})
+
+    def missing_fields(self, names: list[str] = None) -> list[str]:
+        """
+        :param names: The field names that should be checked. Checks all fields, if this is not set
+        :return: The names of all fields that are not set yet
+        """
+        if names is None:
+            names = [field.name for field in fields(self)]
+        return [name for name in names if getattr(self, name) is None]
+
+    def update(self, source: dict[str, str]) -> None:
+        """
+        Set all fields of this object that are contained in `source`. Unknown keys are ignored.
+        :param source: A dict-representation of a client as returned by a `ts3.query.TS3Connection` command
+        """
+        for field in fields(self):
+            if field.name in source:
+                setattr(self, field.name, source[field.name])
+
+
+def _parse_int(value: typing.Optional[str]) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _parse_flag(value: typing.Optional[str]) -> bool:
+    return str(value) == '1'
+
+
+@dataclass
+class ClientView:
+    """
+    Compact, typed projection of the `ClientInfo` fields a `User` displays. Numeric and boolean fields are parsed once
+    when the view is created, so rendering does not parse them again. The class uses `__slots__`, so a view only keeps
+    these few values instead of the 60 strings of a `ClientInfo`.
+    """
+    __slots__ = ('channel_id', 'nickname', 'idle_time', 'input_muted', 'output_muted', 'away', 'country',
+                 'base64_hash_client_uid', 'flag_avatar')
+    channel_id: typing.Optional[str]
+    nickname: typing.Optional[str]
+    """
+    Idle time in milliseconds
+    """
+    idle_time: int
+    input_muted: bool
+    output_muted: bool
+    away: bool
+    country: typing.Optional[str]
+    base64_hash_client_uid: typing.Optional[str]
+    flag_avatar: typing.Optional[str]
+
+    @staticmethod
+    def from_dict(source: typing.Mapping[str, typing.Any]) -> 'ClientView':
+        """
+        :param source: A dict-representation of a client as returned by the `clientinfo` or `clientlist` command
+        :return: The view of that client
+        """
+        return ClientView(channel_id=source.get('cid'),
+                          nickname=source.get('client_nickname'),
+                          idle_time=_parse_int(source.get('client_idle_time')),
+                          input_muted=_parse_flag(source.get('client_input_muted')),
+                          output_muted=_parse_flag(source.get('client_output_muted')),
+                          away=_parse_flag(source.get('client_away')),
+                          country=source.get('client_country'),
+                          base64_hash_client_uid=source.get('client_base64HashClientUID'),
+                          flag_avatar=source.get('client_flag_avatar'))
+
+    @staticmethod
+    def from_client_info(client_info: ClientInfo) -> 'ClientView':
+        """
+        :param client_info: A complete or partial `ClientInfo`
+        :return: The view of that client
+        """
+        return ClientView.from_dict(client_info.__dict__)
+
 
 fake_user_base_client_info: ClientInfo
 
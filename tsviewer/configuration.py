@@ -32,6 +32,32 @@ class Configuration(object):
         clean_up_upload_channel: True if the upload channel cleanup method should run on startup
         debug: True if the application should run in debug mode
         log_path: Path to the log file, if one should be created. If this is not set, logs will go to the console
+        query_keepalive_interval: Seconds after which an idle query connection is checked and kept alive
+        query_pool_min_size: Number of query connections that are kept open
+        query_pool_max_size: Maximum number of concurrent query connections
+        query_pool_timeout: Seconds a request waits for a free query connection
+        query_flood_commands: Maximum number of pipelined commands, that are sent at once. Keep this at the
+                              `serverinstance_serverquery_flood_commands` of the Teamspeak server
+        query_flood_time: Seconds between two chunks of pipelined commands, the `serverinstance_serverquery_flood_time`
+                          of the Teamspeak server. Set this to 0, if the query host is on the query IP whitelist
+        server_state_enabled: True if clients and channels should be tracked in memory via server notifications
+        server_state_resync_interval: Seconds after which the in-memory server state is refreshed with a full snapshot
+        avatar_cache_path: Path to the file that remembers which avatar version was downloaded for each client
+        file_transfer_timeout: Seconds a file transfer connection may block before it is aborted
+        file_transfer_concurrency: Maximum number of concurrent file transfers for bulk downloads
+        file_transfer_retries: Number of retries for a failed file transfer in bulk downloads
+        file_list_cache_ttl: Seconds the file listing of all channels is cached
+        upload_cleanup_state_path: Path to the file that remembers which uploads the cleanup already moved
+        upload_cleanup_max_attempts: Number of failed moves after which the cleanup gives up on a file
+        download_cache_path: Directory of the disk cache for files served by the download route
+        download_cache_max_bytes: Size limit of the download cache in bytes. The cache is disabled, if this is 0
+        server_ids: All virtual server ids this process watches. Defaults to `[server_id]`. `server_id` is the default
+                    server, that is served at the root routes and whose upload channel is cleaned up
+        refresh_users_interval: Seconds between two background refreshes of the user list. 0 fetches it per request
+        refresh_channels_interval: Seconds between two background refreshes of the channel list
+        refresh_files_interval: Seconds between two background refreshes of the file listing. Keep this below
+                                `file_list_cache_ttl`, so requests never list the files themselves
+        refresh_jitter: Maximum random deviation from each refresh interval as fraction of the interval
     """
     server_query_host: str
     server_query_port: int
@@ -53,6 +79,28 @@ class Configuration(object):
     clean_up_upload_channel: bool
     debug: bool
     log_path: str
+    query_keepalive_interval: int = 60
+    query_pool_min_size: int = 1
+    query_pool_max_size: int = 4
+    query_pool_timeout: int = 30
+    query_flood_commands: int = 10
+    query_flood_time: float = 3
+    server_state_enabled: bool = True
+    server_state_resync_interval: int = 60
+    avatar_cache_path: str = 'cache/avatar_cache.json'
+    file_transfer_timeout: int = 10
+    file_transfer_concurrency: int = 8
+    file_transfer_retries: int = 2
+    file_list_cache_ttl: int = 60
+    upload_cleanup_state_path: str = 'cache/upload_cleanup.json'
+    upload_cleanup_max_attempts: int = 3
+    download_cache_path: str = 'cache/downloads'
+    download_cache_max_bytes: int = 0
+    server_ids: Optional[list[int]] = None
+    refresh_users_interval: int = 5
+    refresh_channels_interval: int = 30
+    refresh_files_interval: int = 30
+    refresh_jitter: float = 0.1
 
     @staticmethod
     def get_instance() -> 'Configuration':
@@ -143,6 +191,18 @@ def authorize(configuration: Configuration, connection: ts3.query.TS3Connection)
     connection.use(sid=configuration.server_id)
 
 
+def get_server_ids(configuration: Configuration) -> list[int]:
+    """
+    :param configuration: `Configuration` object
+    :return: All virtual server ids to watch, starting with the default `server_id`
+    """
+    server_ids = [configuration.server_id]
+    for server_id in configuration.server_ids or list():
+        if str(server_id) not in [str(known_server_id) for known_server_id in server_ids]:
+            server_ids.append(server_id)
+    return server_ids
+
+
 def read_environment_variables(configuration: Configuration) -> None:
     """
     Overwrite all configuration fields when there are configured environment variables for those fields.
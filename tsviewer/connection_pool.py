@@ -0,0 +1,204 @@
+import typing
+from contextlib import contextmanager
+from threading import Condition
+
+import ts3
+
+from tsviewer.configuration import Configuration
+from tsviewer.logger import logger
+from tsviewer.query_connection import QueryConnection
+
+__all__ = ['QueryConnectionPool', 'BoundConnectionPool', 'ConnectionPoolExhaustedException']
+
+
+class ConnectionPoolExhaustedException(Exception):
+    """
+    Named exception that is raised when no query connection became available within the pool timeout
+    """
+    pass
+
+
+class QueryConnectionPool(object):
+    """
+    A bounded pool of authorized query connections, so concurrent requests don't share (and interleave on) one socket.
+    Use `connection()` for sequences of commands that need the same connection, e.g. moving the query client and
+    sending a channel message afterwards. Single commands can be called on the pool directly, e.g. `pool.clientlist()`,
+    which checks out a connection for the duration of that command.
+    """
+
+    def __init__(self, configuration: Configuration = None, min_size: int = None, max_size: int = None,
+                 timeout: float = None) -> None:
+        """
+        :param configuration: `Configuration` object, `Configuration.get_instance()` is used if this is not set
+        :param min_size: Number of connections that are kept open. Defaults to `Configuration.query_pool_min_size`
+        :param max_size: Maximum number of connections. Defaults to `Configuration.query_pool_max_size`
+        :param timeout: Seconds `checkout` waits for a free connection. Defaults to `Configuration.query_pool_timeout`
+        """
+        self.configuration = configuration if configuration is not None else Configuration.get_instance()
+        self.min_size = min_size if min_size is not None else self.configuration.query_pool_min_size
+        self.max_size = max(self.min_size, max_size if max_size is not None else self.configuration.query_pool_max_size)
+        self.timeout = timeout if timeout is not None else self.configuration.query_pool_timeout
+        self._condition = Condition()
+        self._idle = [QueryConnection(self.configuration) for _ in range(self.min_size)]
+        self._size = self.min_size
+
+    @property
+    def size(self) -> int:
+        """
+        :return: Number of connections in the pool, including the checked out ones
+        """
+        return self._size
+
+    def fill(self) -> None:
+        """
+        Open all idle connections that are not connected yet
+        :raises ts3.TS3Error: If the login or `use` command failed
+        :raises OSError: If the server could not be reached
+        """
+        with self._condition:
+            idle = list(self._idle)
+        for connection in idle:
+            if not connection.is_connected():
+                connection.open()
+
+    def checkout(self, server_id: int = None) -> QueryConnection:
+        """
+        Take a connection out of the pool. A new connection is created, if all connections are in use and the pool
+        is not full yet. Connections that were idle for longer than `Configuration.query_keepalive_interval` are
+        health checked first. Every checked out connection has to be returned with `checkin`.
+        :param server_id: The virtual server the connection should use. Defaults to `Configuration.server_id`
+        :return: A `QueryConnection`
+        :raises ConnectionPoolExhaustedException: If no connection became available within the timeout
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._idle or self._size < self.max_size, self.timeout):
+                raise ConnectionPoolExhaustedException(f'No query connection became available within '
+                                                       f'{self.timeout} seconds')
+            if self._idle:
+                # Prefer a connection that already uses the requested virtual server, so no `use` command is needed
+                wanted = str(server_id if server_id is not None else self.configuration.server_id)
+                index = next((index for index in range(len(self._idle) - 1, -1, -1)
+                              if str(self._idle[index].server_id) == wanted), len(self._idle) - 1)
+                connection = self._idle.pop(index)
+            else:
+                connection = QueryConnection(self.configuration)
+                self._size += 1
+        try:
+            connection.heartbeat(self.configuration.query_keepalive_interval)
+            connection.use(server_id if server_id is not None else self.configuration.server_id)
+        except BaseException:
+            self.checkin(connection)
+            raise
+        return connection
+
+    def checkin(self, connection: QueryConnection) -> None:
+        """
+        Return a connection to the pool
+        :param connection: A connection obtained by `checkout`
+        """
+        with self._condition:
+            self._idle.append(connection)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, server_id: int = None) -> typing.Iterator[QueryConnection]:
+        """
+        Check out a connection for the duration of the `with` block
+        :param server_id: The virtual server the connection should use. Defaults to `Configuration.server_id`
+        """
+        connection = self.checkout(server_id)
+        try:
+            yield connection
+        finally:
+            self.checkin(connection)
+
+    def heartbeat(self, interval: float) -> None:
+        """
+        Close idle connections that exceed `min_size` and keep the remaining idle connections alive. This is called
+        by `Heartbeat`.
+        :param interval: The heartbeat interval in seconds
+        """
+        surplus = list()
+        with self._condition:
+            while self._size > self.min_size and self._idle and self._idle[0].idle_time >= interval:
+                surplus.append(self._idle.pop(0))
+                self._size -= 1
+            idle = list(self._idle)
+        for connection in surplus:
+            connection.close()
+        if surplus:
+            logger.debug(f'Closed {len(surplus)} surplus query connections')
+        for connection in idle:
+            connection.heartbeat(interval)
+
+    def bind(self, server_id: int) -> 'BoundConnectionPool':
+        """
+        :param server_id: A virtual server id
+        :return: A view of this pool, whose connections always use that virtual server
+        """
+        return BoundConnectionPool(self, server_id)
+
+    def close(self) -> None:
+        """
+        Close all idle connections
+        """
+        with self._condition:
+            idle = list(self._idle)
+        for connection in idle:
+            connection.close()
+
+    def __getattr__(self, name: str) -> typing.Any:
+        attribute = getattr(ts3.query.TS3Connection, name)
+        if not callable(attribute):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs) -> typing.Any:
+            with self.connection() as connection:
+                return connection.execute(name, *args, **kwargs)
+
+        return command
+
+
+class BoundConnectionPool(object):
+    """
+    A view of a shared `QueryConnectionPool`, that checks out every connection for one virtual server. It offers the
+    same interface as the pool, e.g. `bound_pool.connection()` or `bound_pool.clientlist()`.
+    """
+
+    def __init__(self, pool: QueryConnectionPool, server_id: int) -> None:
+        """
+        :param pool: The shared pool
+        :param server_id: The virtual server the connections use
+        """
+        self.pool = pool
+        self.server_id = server_id
+
+    @property
+    def max_size(self) -> int:
+        return self.pool.max_size
+
+    def fill(self) -> None:
+        self.pool.fill()
+
+    def checkout(self) -> QueryConnection:
+        return self.pool.checkout(self.server_id)
+
+    def checkin(self, connection: QueryConnection) -> None:
+        self.pool.checkin(connection)
+
+    def connection(self) -> typing.ContextManager[QueryConnection]:
+        return self.pool.connection(self.server_id)
+
+    def heartbeat(self, interval: float) -> None:
+        self.pool.heartbeat(interval)
+
+    def __getattr__(self, name: str) -> typing.Any:
+        attribute = getattr(ts3.query.TS3Connection, name)
+        if not callable(attribute):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs) -> typing.Any:
+            with self.connection() as connection:
+                return connection.execute(name, *args, **kwargs)
+
+        return command
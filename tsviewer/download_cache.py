@@ -0,0 +1,117 @@
+import typing
+from collections import OrderedDict
+from hashlib import sha1
+from pathlib import Path
+from threading import Lock
+from uuid import uuid4
+
+from tsviewer.configuration import Configuration
+from tsviewer.logger import logger
+from tsviewer.path_utils import resolve_with_project_path
+
+__all__ = ['DownloadCache']
+
+
+class DownloadCache(object):
+    """
+    Local disk cache for channel files that are served by the download route. Each file is stored under a hash of its
+    virtual server id, channel id, path, size and timestamp, so a changed file on the server is never served from the
+    cache. When the cache exceeds `Configuration.download_cache_max_bytes`, the least recently used files are deleted.
+    The files that are already in the cache directory are picked up on start, ordered by their modification time.
+    """
+
+    def __init__(self, path: str = None, max_bytes: int = None) -> None:
+        """
+        :param path: The cache directory. Defaults to `Configuration.download_cache_path`
+        :param max_bytes: The maximum size of the cache. Defaults to `Configuration.download_cache_max_bytes`. The
+                          cache is disabled, if this is 0
+        """
+        configuration = Configuration.get_instance()
+        self.path = resolve_with_project_path(path if path is not None else configuration.download_cache_path)
+        self.max_bytes = max_bytes if max_bytes is not None else configuration.download_cache_max_bytes
+        self._lock = Lock()
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        if self.enabled:
+            self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(server_id: typing.Union[int, str], channel_id: str, file_path: str, file_info: dict[str, str]) -> str:
+        """
+        :param server_id: The virtual server id
+        :param channel_id: The channel id
+        :param file_path: The path of the file within the channel
+        :param file_info: The `FTGETFILEINFO` entry of the file
+        :return: The cache key of this version of the file
+        """
+        return sha1(f'{server_id}/{channel_id}/{file_path}/{file_info.get("size")}/{file_info.get("datetime")}'
+                    .encode()).hexdigest()
+
+    def lookup(self, key: str) -> typing.Optional[Path]:
+        """
+        :param key: The cache key, see `DownloadCache.key`
+        :return: The path of the cached file or `None`
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        path = self.path / key
+        return path if path.is_file() else None
+
+    def accepts(self, size: int) -> bool:
+        """
+        :param size: The file size in bytes
+        :return: True if a file of that size may be cached
+        """
+        return self.enabled and size <= self.max_bytes
+
+    def write_through(self, key: str, chunks: typing.Iterable[bytes]) -> typing.Iterator[bytes]:
+        """
+        Pass the chunks of a complete file through and write them to the cache at the same time. The file is only
+        added to the cache, if all chunks were passed through, e.g. not if the HTTP client disconnected early.
+        :param key: The cache key, see `DownloadCache.key`
+        :param chunks: The content of the file
+        :return: The same chunks
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        partial_path = self.path / f'{key}.{uuid4().hex}.part'
+        try:
+            with partial_path.open('wb') as partial_file:
+                for chunk in chunks:
+                    partial_file.write(chunk)
+                    yield chunk
+            self._store(key, partial_path)
+        finally:
+            partial_path.unlink(missing_ok=True)
+
+    def _store(self, key: str, partial_path: Path) -> None:
+        size = partial_path.stat().st_size
+        partial_path.replace(self.path / key)
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._size += size
+            evicted = list()
+            while self._size > self.max_bytes and self._entries:
+                evicted_key, evicted_size = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            (self.path / evicted_key).unlink(missing_ok=True)
+        if evicted:
+            logger.debug(f'Evicted {len(evicted)} files from the download cache')
+
+    def _load(self) -> None:
+        if not self.path.is_dir():
+            return None
+        for path in self.path.glob('*.part'):
+            path.unlink(missing_ok=True)
+        for path in sorted(self.path.iterdir(), key=lambda file: file.stat().st_mtime):
+            if path.is_file():
+                self._entries[path.name] = path.stat().st_size
+                self._size += self._entries[path.name]
@@ -1,83 +1,304 @@
 import os
 import socket
-from typing import Optional
+from dataclasses import dataclass, field
+from typing import Optional, BinaryIO, Callable, Iterator
 
 import ts3
-from time import sleep
+from werkzeug.datastructures import Range
 from pathlib import Path
 from imghdr import what
-from io import BytesIO
 from tsviewer.configuration import Configuration
 from tsviewer.logger import logger
-from tsviewer.ts_viewer_utils import TimeUtil
 
-__all__ = ['download_file', 'upload_file']
+__all__ = ['download_file', 'download_file_to_path', 'stream_download', 'upload_file', 'upload_stream',
+           'get_byte_range', 'TransferReport', 'IncompleteTransferException', 'RangeNotSatisfiableException']
+
+"""
+Size of the buffer that is reused for every `recv_into` call, when a file is streamed to disk
+"""
+CHUNK_SIZE = 64 * 1024
+
+"""
+`status` of a `FTINITDOWNLOAD` reply for a file, that does not exist
+"""
+FILE_NOT_FOUND_STATUS = '2051'
+
+"""
+Number of bytes handed to a single `socket.sendfile` call, i.e. the granularity of the upload progress
+"""
+SENDFILE_CHUNK_SIZE = 1024 * 1024
+
+
+class IncompleteTransferException(Exception):
+    """
+    Named exception that is raised when the file transfer connection closed before the announced size was received
+    """
+    pass
+
+
+class RangeNotSatisfiableException(Exception):
+    """
+    Named exception that is raised when a requested byte range lies outside of the file
+    """
+    pass
+
+
+@dataclass
+class TransferReport:
+    """
+    Summary of a bulk file transfer
+    """
+    succeeded: list[str] = field(default_factory=list)
+    failed: list[str] = field(default_factory=list)
+    attempts: int = 0
+
+
+def _open_transfer_connection(file_transfer_init_response: ts3.query.TS3QueryResponse) -> socket.socket:
+    """
+    Connect to the file transfer port announced by `FTINITDOWNLOAD` or `FTINITUPLOAD` and send the transfer key
+    :param file_transfer_init_response: The response object of the `FTINITDOWNLOAD` or `FTINITUPLOAD` command
+    :return: The connected socket. It has to be closed by the caller
+    """
+    configuration = Configuration.get_instance()
+    port = int(file_transfer_init_response.parsed[0].get('port', 30033))
+    address = (configuration.server_query_host, port)
+    sock = socket.create_connection(address, timeout=configuration.file_transfer_timeout)
+    try:
+        sock.sendall(file_transfer_init_response.parsed[0]['ftkey'].encode())
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _receive_into(sock: socket.socket, buffer: memoryview) -> None:
+    """
+    Fill the whole buffer with data from the socket
+    :param sock: The connected file transfer socket
+    :param buffer: A writable memoryview, e.g. of a preallocated `bytearray`
+    :raises IncompleteTransferException: If the peer closed the connection before the buffer was filled
+    """
+    received = 0
+    while received < len(buffer):
+        count = sock.recv_into(buffer[received:])
+        if count == 0:
+            raise IncompleteTransferException(f'Connection closed after {received} of {len(buffer)} bytes')
+        received += count
+
+
+def _stream_into_file(sock: socket.socket, file: BinaryIO, size: int) -> None:
+    """
+    Write exactly `size` bytes from the socket to the file, without holding more than `CHUNK_SIZE` bytes in memory
+    :param sock: The connected file transfer socket
+    :param file: A file opened in binary write mode
+    :param size: The number of bytes announced by `FTINITDOWNLOAD`
+    :raises IncompleteTransferException: If the peer closed the connection before `size` bytes were received
+    """
+    chunk = memoryview(bytearray(min(CHUNK_SIZE, size)))
+    received = 0
+    while received < size:
+        count = sock.recv_into(chunk[:size - received])
+        if count == 0:
+            raise IncompleteTransferException(f'Connection closed after {received} of {size} bytes')
+        file.write(chunk[:count])
+        received += count
+
+
+def _get_transfer_error(file_transfer_init_response: ts3.query.TS3QueryResponse, command: str) -> Optional[str]:
+    message = file_transfer_init_response.parsed[0].get('msg')
+    if message:
+        logger.error(f'{command} failed with {message}')
+    return message
+
+
+def _get_download_error(file_transfer_init_download_response: ts3.query.TS3QueryResponse) -> Optional[str]:
+    return _get_transfer_error(file_transfer_init_download_response, 'FTINITDOWNLOAD')
 
 
 def download_file(file_transfer_init_download_response: ts3.query.TS3QueryResponse, file_name: str) -> Optional[str]:
     """
-    This starts the file transfer initiated by the `FTINITDOWNLOADFILE` command
+    This starts the file transfer initiated by the `FTINITDOWNLOADFILE` command. The file is received into a
+    preallocated buffer, so the file type of the avatar can be detected before it is written to the `static` folder
     :param file_transfer_init_download_response: The response object of the `FTINITDOWNLOADFILE`
     :param file_name: The file name for the file that is written to the `static` folder
     :return: The file path of the created file as string or `None`
     """
-    message = file_transfer_init_download_response.parsed[0].get('msg')
-    if message:
-        logger.error(f'FTINITDOWNLOAD failed with {message}')
+    if _get_download_error(file_transfer_init_download_response):
         return None
-    configuration = Configuration.get_instance()
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    port = int(file_transfer_init_download_response.parsed[0].get('port', 30033))
-    address = (configuration.server_query_host, port)
     file_path = None
     try:
-        sock.connect(address)
-        sock.sendall(file_transfer_init_download_response.parsed[0]['ftkey'].encode())
         size = int(file_transfer_init_download_response.parsed[0]['size'])
-        image = b''
-        while True:
-            response_bytes = sock.recv(size)
-            image += response_bytes
-            sleep(TimeUtil.to_milliseconds(250))
-            if response_bytes == b'':
-                break
-
-        file_extension = what(BytesIO(image))
+        image = bytearray(size)
+        with _open_transfer_connection(file_transfer_init_download_response) as sock:
+            _receive_into(sock, memoryview(image))
+
+        file_extension = what(None, h=image)
         file_path = f'static/avatars/{file_name}.{file_extension}'
         with Path(file_path).open('wb') as avatar_file:
             avatar_file.write(image)
         logger.info(f'File successfully downloaded and written to {file_path}')
-    except (socket.error, OSError, ts3.query.TS3QueryError) as exception:
+    except (socket.error, OSError, ts3.query.TS3QueryError, IncompleteTransferException) as exception:
         error_message = f'Due to the exception {exception} the download of file {file_name} did not succeed'
         logger.error(error_message)
-    finally:
-        sock.close()
+        file_path = None
     return file_path
 
 
-def upload_file(file_transfer_init_upload_response: ts3.query.TS3QueryResponse, file_name: os.PathLike) -> None:
-    # TODO: Test this
+def download_file_to_path(file_transfer_init_download_response: ts3.query.TS3QueryResponse,
+                          path: os.PathLike, offset: int = 0) -> Optional[Path]:
     """
-    This starts the file transfer initiated by the `FTINITUPLOADFILE` command
-    :param file_transfer_init_upload_response: The response object of the `FTINITUPLOADFILE`
-    :param file_name: The file name for the file that is uploaded to the channel specified prior
+    This starts the file transfer initiated by the `FTINITDOWNLOADFILE` command and streams the file straight to disk.
+    Every received chunk is written right away, so a broken transfer leaves everything received so far on disk and
+    can be continued by initiating the download again with `seekpos` set to the size of the written file.
+    :param file_transfer_init_download_response: The response object of the `FTINITDOWNLOADFILE`
+    :param path: The path of the file that is written
+    :param offset: The `seekpos` the download was initiated with. The file is truncated to this size and the received
+                   data is appended
+    :return: The path of the created file or `None`, if the file does not have the size announced by the server
     """
+    if _get_download_error(file_transfer_init_download_response):
+        return None
+    path = Path(path)
+    try:
+        size = int(file_transfer_init_download_response.parsed[0]['size'])
+        if offset > size:
+            raise IncompleteTransferException(f'The partial file has {offset} bytes, but the file only has {size}')
+        with _open_transfer_connection(file_transfer_init_download_response) as sock, \
+                path.open('r+b' if offset and path.is_file() else 'wb') as file:
+            file.truncate(offset)
+            file.seek(offset)
+            _stream_into_file(sock, file, size - offset)
+        if path.stat().st_size != size:
+            raise IncompleteTransferException(f'{path} has {path.stat().st_size} bytes, but {size} were announced')
+        logger.info(f'File successfully downloaded and written to {path}')
+    except (socket.error, OSError, ts3.query.TS3QueryError, IncompleteTransferException) as exception:
+        error_message = f'Due to the exception {exception} the download of file {path} did not succeed'
+        logger.error(error_message)
+        return None
+    return path
 
-    with Path(file_name).open('rb') as file:
-        content = file.read()
 
-    configuration = Configuration.get_instance()
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    port = int(file_transfer_init_upload_response.parsed[0].get('port', 30033))
-    address = (configuration.server_query_host, port)
+def stream_download(file_transfer_init_download_response: ts3.query.TS3QueryResponse, offset: int = 0,
+                    length: Optional[int] = None) -> Iterator[bytes]:
+    """
+    This starts the file transfer initiated by the `FTINITDOWNLOADFILE` command and returns an iterator over the file
+    in chunks of at most `CHUNK_SIZE` bytes, e.g. to pass it on in an HTTP response. The reply is checked and the
+    transfer connection is opened before this returns, so a failed transfer is noticed before a response is sent
+    :param file_transfer_init_download_response: The response object of the `FTINITDOWNLOADFILE`
+    :param offset: The `seekpos` the download was initiated with
+    :param length: The number of bytes to yield. Defaults to the rest of the file
+    :return: The chunks. The iterator raises `IncompleteTransferException`, if the connection closed early
+    :raises FileNotFoundError: If the server does not have the file
+    :raises IncompleteTransferException: If the server announced another error
+    :raises OSError: If the file transfer port could not be reached
+    """
+    message = _get_download_error(file_transfer_init_download_response)
+    if message:
+        if file_transfer_init_download_response.parsed[0].get('status') == FILE_NOT_FOUND_STATUS:
+            raise FileNotFoundError(message)
+        raise IncompleteTransferException(message)
+    size = int(file_transfer_init_download_response.parsed[0]['size'])
+    remaining = size - offset if length is None else length
+    return _iter_chunks(_open_transfer_connection(file_transfer_init_download_response), remaining)
+
+
+def get_byte_range(byte_range: Optional[Range], size: int) -> Optional[tuple[int, int]]:
+    """
+    Map the `Range` header of a download request to the part of the file, that is transferred. The start is used as
+    `seekpos` of the `FTINITDOWNLOADFILE` command. Only single ranges are supported, so multiple ranges are answered
+    with the whole file
+    :param byte_range: The parsed `Range` header, e.g. `flask.request.range`
+    :param size: The file size
+    :return: The start and the exclusive end of the range or `None`, if the whole file is transferred
+    :raises RangeNotSatisfiableException: If the range does not overlap the file
+    """
+    if byte_range is None or len(byte_range.ranges) != 1:
+        return None
+    start_and_stop = byte_range.range_for_length(size)
+    if start_and_stop is None:
+        raise RangeNotSatisfiableException(f'The range {byte_range} does not overlap the {size} bytes of the file')
+    return start_and_stop
+
+
+def _iter_chunks(sock: socket.socket, remaining: int) -> Iterator[bytes]:
+    with sock:
+        while remaining > 0:
+            chunk = sock.recv(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise IncompleteTransferException(f'Connection closed with {remaining} bytes left')
+            remaining -= len(chunk)
+            yield chunk
+
+
+def upload_file(file_transfer_init_upload_response: ts3.query.TS3QueryResponse, file_name: os.PathLike,
+                progress: Optional[Callable[[int, int], None]] = None) -> bool:
+    """
+    This starts the file transfer initiated by the `FTINITUPLOADFILE` command. The file is streamed from disk with
+    `socket.sendfile`, which uses `os.sendfile` where available, so it is never loaded into memory. If the server
+    announced a `seekpos` because the upload was initiated with `resume=1`, only the rest of the file is sent.
+    :param file_transfer_init_upload_response: The response object of the `FTINITUPLOADFILE`
+    :param file_name: The file name for the file that is uploaded to the channel specified prior
+    :param progress: Called with the number of bytes the server has and the file size after every chunk
+    :return: True if the whole file was sent
+    """
+    if _get_transfer_error(file_transfer_init_upload_response, 'FTINITUPLOAD'):
+        return False
+    path = Path(file_name)
     try:
-        sock.connect(address)
-        sock.sendall(file_transfer_init_upload_response.parsed[0]['ftkey'].encode())
-        sleep(TimeUtil.to_milliseconds(400))
-        sock.sendall(content)
-        logger.info(f'File successfully uploaded')
-    except (socket.error, OSError, ts3.query.TS3QueryError) as exception:
+        size = path.stat().st_size
+        offset = int(file_transfer_init_upload_response.parsed[0].get('seekpos', 0))
+        with _open_transfer_connection(file_transfer_init_upload_response) as sock, path.open('rb') as file:
+            if progress is not None:
+                progress(offset, size)
+            while offset < size:
+                sent = sock.sendfile(file, offset, min(SENDFILE_CHUNK_SIZE, size - offset))
+                if sent == 0:
+                    raise IncompleteTransferException(f'Sending stopped after {offset} of {size} bytes')
+                offset += sent
+                if progress is not None:
+                    progress(offset, size)
+            _finish_upload(sock)
+        logger.info(f'File {path} successfully uploaded')
+    except (socket.error, OSError, ts3.query.TS3QueryError, IncompleteTransferException) as exception:
         error_message = f'Due to the exception {exception} the upload of file {file_name} did not succeed'
         logger.error(error_message)
-    finally:
-        sock.close()
+        return False
+    return True
+
+
+def upload_stream(file_transfer_init_upload_response: ts3.query.TS3QueryResponse, stream: BinaryIO, size: int,
+                  progress: Optional[Callable[[int, int], None]] = None) -> bool:
+    """
+    This starts the file transfer initiated by the `FTINITUPLOADFILE` command and sends `size` bytes read from the
+    stream, e.g. the body of an HTTP request. Not more than `CHUNK_SIZE` bytes are held in memory at once.
+    :param file_transfer_init_upload_response: The response object of the `FTINITUPLOADFILE`
+    :param stream: A readable binary stream
+    :param size: The number of bytes announced to `FTINITUPLOADFILE`
+    :param progress: Called with the number of sent bytes and `size` after every chunk
+    :return: True if `size` bytes were sent
+    """
+    if _get_transfer_error(file_transfer_init_upload_response, 'FTINITUPLOAD'):
+        return False
+    try:
+        with _open_transfer_connection(file_transfer_init_upload_response) as sock:
+            sent = 0
+            while sent < size:
+                chunk = stream.read(min(CHUNK_SIZE, size - sent))
+                if not chunk:
+                    raise IncompleteTransferException(f'The stream ended after {sent} of {size} bytes')
+                sock.sendall(chunk)
+                sent += len(chunk)
+                if progress is not None:
+                    progress(sent, size)
+            _finish_upload(sock)
+        logger.info(f'Stream of {size} bytes successfully uploaded')
+    except (socket.error, OSError, ts3.query.TS3QueryError, IncompleteTransferException) as exception:
+        logger.error(f'Due to the exception {exception} the upload of a stream did not succeed')
+        return False
+    return True
+
+
+def _finish_upload(sock: socket.socket) -> None:
+    # The server closes the connection once it received the whole file
+    sock.shutdown(socket.SHUT_WR)
+    sock.recv(1)
@@ -0,0 +1,52 @@
+import typing
+from hashlib import sha1
+from json import dumps
+from threading import Lock
+from uuid import uuid4
+
+__all__ = ['JsonSnapshotCache']
+
+
+class JsonSnapshotCache(object):
+    """
+    Keeps the serialized JSON body of each API resource together with the version of the data it was built from.
+    As long as the version does not change, the body is neither rebuilt nor re-serialized and the ETag stays the same,
+    so polling clients can be answered with `304 Not Modified`.
+    """
+
+    def __init__(self) -> None:
+        # Versions start at zero with every process, so the ETags of different processes must not collide
+        self._instance = uuid4().hex[:8]
+        self._lock = Lock()
+        self._snapshots: dict[str, tuple[typing.Optional[int], str, bytes]] = dict()
+
+    def etag(self, resource: str, version: int) -> str:
+        """
+        :param resource: The resource name, e.g. `users`
+        :param version: The version of the data
+        :return: The ETag for that version of the resource
+        """
+        return f'{resource}-{self._instance}-{version}'
+
+    def get(self, resource: str, version: typing.Optional[int],
+            build: typing.Callable[[], typing.Any]) -> tuple[str, bytes]:
+        """
+        Return the serialized body of a resource. It is only rebuilt, if the version changed.
+        :param resource: The resource name, e.g. `users`
+        :param version: The version of the data or `None`, if the data is not versioned. Unversioned data is rebuilt
+                        every time and its ETag is derived from the body
+        :param build: A callable that returns the JSON-serializable data
+        :return: A tuple of the ETag and the body
+        """
+        if version is not None:
+            with self._lock:
+                snapshot = self._snapshots.get(resource)
+            if snapshot is not None and snapshot[0] == version:
+                return snapshot[1], snapshot[2]
+        body = dumps(build(), separators=(',', ':')).encode()
+        if version is None:
+            return f'{resource}-{sha1(body).hexdigest()}', body
+        etag = self.etag(resource, version)
+        with self._lock:
+            self._snapshots[resource] = (version, etag, body)
+        return etag, body
@@ -30,11 +30,12 @@ def get_application_name() -> str:
 def create_directories() -> Optional[str]:
     """
     Create all non-existent directories that are being used by the TsViewer
-    Currently, there are `2` directories not included in the project structure:
+    Currently, there are `3` directories not included in the project structure:
     /static/avatars
+    /cache
     /log
     """
-    paths = ['static/avatars']
+    paths = ['static/avatars', 'cache']
     for path_string in paths:
         path = Path(path_string)
         if path.is_dir():
@@ -0,0 +1,324 @@
+import time
+import typing
+from threading import RLock, Thread, Event
+
+import ts3
+from ts3.commands import TS3Commands
+from ts3.escape import TS3Escape
+from ts3.response import TS3QueryResponse
+
+from tsviewer.configuration import authorize, Configuration
+from tsviewer.logger import logger
+
+__all__ = ['QueryConnection', 'QueryBatch', 'BatchResult', 'Heartbeat', 'CONNECTION_ERRORS', 'is_read_only']
+
+"""
+Exceptions that mean the connection itself is broken, as opposed to `ts3.query.TS3QueryError`, which is raised when
+the server answered with an error
+"""
+CONNECTION_ERRORS = (ts3.query.TS3RecvError, ts3.query.TS3TimeoutError, OSError, EOFError)
+
+"""
+Read-only commands, whose names don't end with `list`, `info` or `find`
+"""
+_READ_ONLY_COMMANDS = ['whoami', 'version', 'use', 'logview']
+
+
+def is_read_only(command_name: str) -> bool:
+    """
+    A read-only command can be issued again, if the connection broke while it was running. Other commands like
+    `clientmove` or `sendtextmessage` may already have been executed by the server, so they are not repeated.
+    :param command_name: The query command, e.g. `clientlist`
+    :return: True if the command does not change anything on the server
+    """
+    return command_name in _READ_ONLY_COMMANDS or command_name.endswith(('list', 'info', 'find'))
+
+
+class QueryConnection(object):
+    """
+    Wrapper around `ts3.query.TS3Connection`. It remembers when the connection last succeeded and reconnects, when a
+    command fails because the connection was lost. Only read-only commands are issued a second time. All
+    `ts3.query.TS3Connection` commands can be called on this object directly, e.g. `query_connection.clientlist()`.
+    """
+    _connection: typing.Optional[ts3.query.TS3Connection]
+
+    def __init__(self, configuration: Configuration = None, server_id: int = None) -> None:
+        """
+        The connection is not opened before the first command is issued or `open` is called.
+        :param configuration: `Configuration` object, `Configuration.get_instance()` is used if this is not set
+        :param server_id: The virtual server this connection uses. Defaults to `Configuration.server_id`
+        """
+        self.configuration = configuration if configuration is not None else Configuration.get_instance()
+        self.server_id = server_id if server_id is not None else self.configuration.server_id
+        self._connection = None
+        self._lock = RLock()
+        self.last_success = 0.0
+        self.connected_since = 0.0
+
+    def open(self) -> None:
+        """
+        Connect and authorize against the configured Teamspeak server
+        :raises ts3.TS3Error: If the login or `use` command failed
+        :raises OSError: If the server could not be reached
+        """
+        with self._lock:
+            self.close()
+            connection = ts3.query.TS3Connection(self.configuration.server_query_host,
+                                                 self.configuration.server_query_port)
+            authorize(self.configuration, connection)
+            if str(self.server_id) != str(self.configuration.server_id):
+                connection.use(sid=self.server_id)
+            self._connection = connection
+            self.last_success = time.monotonic()
+            self.connected_since = self.last_success
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                try:
+                    self._connection.close()
+                except CONNECTION_ERRORS as error:
+                    logger.debug(f'Closing the query connection failed: {error}')
+            self._connection = None
+
+    def is_connected(self) -> bool:
+        return self._connection is not None and self._connection.is_connected()
+
+    def use(self, server_id: int) -> None:
+        """
+        Select the virtual server for all following commands. Nothing is sent, if the server is already selected.
+        :param server_id: Teamspeak virtual server id
+        """
+        with self._lock:
+            if str(server_id) == str(self.server_id) and self.is_connected():
+                return None
+            self.server_id = server_id
+            if self.is_connected():
+                self.execute('use', sid=server_id)
+
+    @property
+    def idle_time(self) -> float:
+        """
+        :return: Seconds since the last command succeeded
+        """
+        return time.monotonic() - self.last_success
+
+    def execute(self, command_name: str, /, *args, **kwargs) -> typing.Any:
+        """
+        Issue the `ts3.query.TS3Connection` command `command_name`. If the connection turns out to be broken, it is
+        closed, so the next command re-establishes it. A read-only command (see `is_read_only`) is issued one more time
+        on the new connection right away.
+        :param command_name: Name of the `ts3.query.TS3Connection` method, e.g. `clientlist`
+        :return: Whatever the command returns, usually a `ts3.query.TS3QueryResponse`
+        """
+        # `send` carries the query command as its first argument
+        query_command = args[0] if command_name == 'send' and args else kwargs.get('command', command_name)
+        retry = is_read_only(query_command)
+        with self._lock:
+            for attempt in range(2):
+                if not self.is_connected():
+                    self.open()
+                try:
+                    result = getattr(self._connection, command_name)(*args, **kwargs)
+                except CONNECTION_ERRORS as error:
+                    logger.info(f'Command {query_command} failed because the connection was lost: {error}')
+                    self.close()
+                    if attempt or not retry:
+                        raise
+                    continue
+                self.last_success = time.monotonic()
+                return result
+
+    def pipeline(self, commands: list[tuple[str, dict, list, list]]) -> list[TS3QueryResponse]:
+        """
+        Write the commands at once and read their replies afterwards, so they cost one network round trip. The flood
+        protection of the server bans a query client, that sends too many commands within a short time. So at most
+        `Configuration.query_flood_commands` commands are written at once, and the next chunk waits until
+        `Configuration.query_flood_time` passed.
+        The replies are returned in the order of the commands. Replies with an error are returned as well, check
+        `response.error['id']`. If the connection turns out to be broken, it is re-established and a chunk of read-only
+        commands is issued one more time.
+        :param commands: Tuples of the command name, common parameters, unique parameters and options
+        :return: The replies
+        """
+        chunk_size = max(1, self.configuration.query_flood_commands)
+        responses = list()
+        with self._lock:
+            chunk_started_at = None
+            for start in range(0, len(commands), chunk_size):
+                if chunk_started_at is not None:
+                    time.sleep(max(0.0, self.configuration.query_flood_time - (time.monotonic() - chunk_started_at)))
+                chunk_started_at = time.monotonic()
+                responses.extend(self._pipeline_chunk(commands[start:start + chunk_size]))
+        return responses
+
+    def _pipeline_chunk(self, commands: list[tuple[str, dict, list, list]]) -> list[TS3QueryResponse]:
+        query = b''.join(' '.join([command,
+                                   TS3Escape.escape_parameters(common_parameters),
+                                   TS3Escape.escape_parameterlist(unique_parameters),
+                                   TS3Escape.escape_options(options)]).encode() + b'\n\r'
+                         for command, common_parameters, unique_parameters, options in commands)
+        retry = all(is_read_only(command) for command, _, _, _ in commands)
+        with self._lock:
+            for attempt in range(2):
+                if not self.is_connected():
+                    self.open()
+                try:
+                    responses = self._pipeline(query, len(commands))
+                except CONNECTION_ERRORS as error:
+                    logger.info(f'Pipelined commands failed because the connection was lost: {error}')
+                    self.close()
+                    if attempt or not retry:
+                        raise
+                    continue
+                self.last_success = time.monotonic()
+                return responses
+
+    # noinspection PyProtectedMember
+    def _pipeline(self, query: bytes, count: int) -> list[TS3QueryResponse]:
+        # `ts3.query.TS3Connection` only supports one command at a time, so its internals are used directly here
+        self._connection.telnet_conn.write(query)
+        self._connection._num_pending_queries += count
+        responses = list()
+        while len(responses) < count:
+            response = self._connection._recv()
+            if isinstance(response, TS3QueryResponse):
+                responses.append(response)
+        return responses
+
+    def wait_for_event(self, timeout: float = None) -> typing.Optional[ts3.response.TS3Event]:
+        """
+        Wait for the next event the connection registered for with `servernotifyregister`. Unlike commands, this does
+        not reconnect on failure, because the registrations would be lost with the old connection.
+        :param timeout: Seconds to wait for an event
+        :return: The event or `None`, if no event was received within the timeout
+        :raises ts3.query.TS3RecvError: If the connection is closed
+        """
+        with self._lock:
+            if not self.is_connected():
+                raise ts3.query.TS3RecvError()
+            try:
+                event = self._connection.wait_for_event(timeout=timeout)
+            except ts3.query.TS3TimeoutError:
+                return None
+            self.last_success = time.monotonic()
+            return event
+
+    def heartbeat(self, interval: float) -> None:
+        """
+        Check the connection with a `whoami` command, if no command succeeded within the last `interval` seconds.
+        A broken connection is closed, so it is re-opened by the next command.
+        :param interval: The heartbeat interval in seconds
+        """
+        if not self.is_connected() or self.idle_time < interval:
+            return None
+        if not self._lock.acquire(blocking=False):
+            # A command is running right now, so the connection is in use anyway
+            return None
+        try:
+            self._connection.whoami()
+            self.last_success = time.monotonic()
+        except (ts3.TS3Error, *CONNECTION_ERRORS) as error:
+            logger.info(f'Heartbeat failed, closing the query connection: {error}')
+            self.close()
+        finally:
+            self._lock.release()
+
+    def __getattr__(self, name: str) -> typing.Any:
+        attribute = getattr(ts3.query.TS3Connection, name)
+        if not callable(attribute):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs) -> typing.Any:
+            return self.execute(name, *args, **kwargs)
+
+        return command
+
+
+class BatchResult(object):
+    """
+    The reply of a command issued within a `QueryBatch`. It is available after the batch was flushed.
+    """
+
+    def __init__(self) -> None:
+        self.response: typing.Optional[TS3QueryResponse] = None
+
+    @property
+    def failed(self) -> bool:
+        """
+        :return: True if the server answered with an error
+        """
+        return self.response.error['id'] != '0'
+
+    def result(self) -> TS3QueryResponse:
+        """
+        :return: The reply
+        :raises ts3.query.TS3QueryError: If the server answered with an error
+        """
+        if self.failed:
+            raise ts3.query.TS3QueryError(self.response)
+        return self.response
+
+
+class QueryBatch(TS3Commands):
+    """
+    Collects query commands and issues them pipelined with `QueryConnection.pipeline`. All `ts3.commands.TS3Commands`
+    methods are available and return a `BatchResult`, e.g. `batch.clientinfo(clid=5)`.
+    """
+
+    def __init__(self) -> None:
+        self._commands: list[tuple[str, dict, list, list]] = list()
+        self._results: list[BatchResult] = list()
+
+    def __len__(self) -> int:
+        return len(self._commands)
+
+    def send(self, command: str, common_parameters: dict = None, unique_parameters: list = None,
+             options: list = None) -> BatchResult:
+        """
+        Add a command to the batch. See `ts3.query.TS3BaseConnection.send`
+        """
+        result = BatchResult()
+        self._commands.append((command, common_parameters, unique_parameters, options))
+        self._results.append(result)
+        return result
+
+    def _return_proxy(self, command: str, cparameters: dict, uparameters: list, options: list) -> BatchResult:
+        return self.send(command, cparameters, uparameters, options)
+
+    def flush(self, connection: QueryConnection) -> None:
+        """
+        Issue all collected commands on the connection and fill in their results
+        :param connection: The connection the commands are issued on
+        """
+        commands, results = self._commands, self._results
+        self._commands, self._results = list(), list()
+        if not commands:
+            return None
+        for result, response in zip(results, connection.pipeline(commands)):
+            result.response = response
+
+
+class Heartbeat(Thread):
+    """
+    Background thread, that keeps idle query connections alive and notices broken ones before a request does.
+    """
+
+    def __init__(self, connections: typing.Callable[[], typing.Iterable[typing.Any]], interval: float) -> None:
+        """
+        :param connections: A callable that returns everything the heartbeat should look after, e.g. `QueryConnection`
+                            or `QueryConnectionPool` objects. All of them have to provide a `heartbeat` method
+        :param interval: The heartbeat interval in seconds. Teamspeak drops idle query clients after 5 minutes
+        """
+        super().__init__(name='tsviewer-heartbeat', daemon=True)
+        self._connections = connections
+        self.interval = interval
+        self._stopped = Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            for connection in self._connections():
+                connection.heartbeat(self.interval)
+
+    def stop(self) -> None:
+        self._stopped.set()
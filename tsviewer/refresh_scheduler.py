@@ -0,0 +1,147 @@
+import random
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, Event
+
+from tsviewer.configuration import Configuration
+from tsviewer.logger import logger
+
+__all__ = ['RefreshScheduler']
+
+
+class RefreshTask(object):
+    """
+    A resource the `RefreshScheduler` keeps up to date, together with its latest snapshot
+    """
+
+    def __init__(self, name: str, refresh: typing.Callable[[], typing.Any], interval: float) -> None:
+        self.name = name
+        self.refresh = refresh
+        self.interval = interval
+        self.lock = Lock()
+        # The value and its version are replaced together, so readers never see a value with the wrong version
+        self.snapshot: tuple[typing.Any, int] = (None, 0)
+        self.refreshed_at: typing.Optional[float] = None
+        self.due = 0.0
+
+
+class RefreshScheduler(Thread):
+    """
+    Background thread, that refreshes resources like the user list or the file listing on their own intervals, so
+    requests read the latest snapshot instead of waiting for the Server Query. Every interval is stretched or shortened
+    by a random jitter, so resources with the same interval don't hit the server at the same time. A refresh that is
+    still running when the resource is due again is skipped instead of starting a second one.
+    Refreshes share the query connection pool with the requests, so each refresh should use only one connection. With
+    the default number of workers, at least one pooled connection stays free for the requests.
+    """
+
+    def __init__(self, jitter: float = None, workers: int = None) -> None:
+        """
+        :param jitter: The maximum deviation from an interval as fraction of it. Defaults to
+                       `Configuration.refresh_jitter`
+        :param workers: Maximum number of concurrent refreshes. Defaults to one less than
+                        `Configuration.query_pool_max_size`
+        """
+        super().__init__(name='tsviewer-refresh-scheduler', daemon=True)
+        configuration = Configuration.get_instance()
+        self.jitter = jitter if jitter is not None else configuration.refresh_jitter
+        workers = workers if workers is not None else configuration.query_pool_max_size - 1
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='tsviewer-refresh')
+        self._lock = Lock()
+        self._tasks: dict[str, RefreshTask] = dict()
+        self._wakeup = Event()
+        self._stopped = Event()
+
+    def add(self, name: str, refresh: typing.Callable[[], typing.Any], interval: float) -> None:
+        """
+        Register a resource. Its first refresh is due within the jitter of its interval, so resources that are added at
+        start up are not all refreshed at once
+        :param name: The resource name, e.g. `1/users`
+        :param refresh: A callable that fetches the resource
+        :param interval: Seconds between two refreshes. If this is 0, the resource is not refreshed in the background
+                         and every read calls `refresh` directly
+        """
+        task = RefreshTask(name, refresh, interval)
+        task.due = time.monotonic() + random.uniform(0, self.jitter * interval)
+        with self._lock:
+            self._tasks[name] = task
+        self._wakeup.set()
+
+    def get(self, name: str) -> typing.Any:
+        """
+        :param name: The resource name
+        :return: The latest snapshot of the resource
+        """
+        return self.snapshot(name)[0]
+
+    def snapshot(self, name: str) -> tuple[typing.Any, typing.Optional[int]]:
+        """
+        Return the latest snapshot of a resource. If the resource was not refreshed yet, it is refreshed by the caller
+        :param name: The resource name
+        :return: A tuple of the snapshot and its version. The version only changes, if the snapshot changed. It is
+                 `None`, if the resource is not refreshed in the background
+        """
+        with self._lock:
+            task = self._tasks[name]
+        if task.interval <= 0:
+            return task.refresh(), None
+        if task.refreshed_at is None:
+            with task.lock:
+                # Another request may have refreshed the resource while this one waited
+                if task.refreshed_at is None:
+                    self._update(task)
+        return task.snapshot
+
+    def refresh(self, name: str) -> typing.Any:
+        """
+        Refresh a resource right away in the caller, e.g. because it is known to have changed, and postpone its next
+        background refresh by one interval
+        :param name: The resource name
+        :return: The new snapshot of the resource
+        """
+        with self._lock:
+            task = self._tasks[name]
+        if task.interval <= 0:
+            return task.refresh()
+        with task.lock:
+            self._update(task)
+            task.due = time.monotonic() + task.interval * (1 + random.uniform(-self.jitter, self.jitter))
+        return task.snapshot[0]
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            with self._lock:
+                tasks = [task for task in self._tasks.values() if task.interval > 0]
+            for task in tasks:
+                if task.due <= now:
+                    task.due = now + task.interval * (1 + random.uniform(-self.jitter, self.jitter))
+                    self._executor.submit(self._refresh, task)
+            next_due = min([task.due for task in tasks], default=now + 1)
+            self._wakeup.wait(max(0.0, next_due - time.monotonic()))
+            self._wakeup.clear()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+        self._executor.shutdown(wait=False)
+
+    def _refresh(self, task: RefreshTask) -> None:
+        if not task.lock.acquire(blocking=False):
+            logger.debug(f'Skipping the refresh of {task.name}, the previous refresh is still running')
+            return None
+        try:
+            self._update(task)
+        except Exception as exception:
+            logger.error(f'Refreshing {task.name} failed, keeping the previous snapshot: {exception}')
+        finally:
+            task.lock.release()
+
+    @staticmethod
+    def _update(task: RefreshTask) -> None:
+        value = task.refresh()
+        previous, version = task.snapshot
+        if task.refreshed_at is None or value != previous:
+            task.snapshot = (value, version + 1)
+        task.refreshed_at = time.monotonic()
@@ -0,0 +1,388 @@
+import time
+import typing
+from collections import deque
+from threading import Condition, Event, Thread
+
+import ts3
+
+from tsviewer.configuration import Configuration
+from tsviewer.logger import logger
+from tsviewer.query_connection import QueryConnection, CONNECTION_ERRORS
+from tsviewer.ts_viewer_utils import TeamspeakCommonKeys, CLIENT_LIST_OPTIONS
+
+__all__ = ['ServerState', 'ServerStateListener']
+
+"""
+Keys of the `notifycliententerview` and `notifyclientmoved` events, that describe the event and not the client
+"""
+_CLIENT_EVENT_KEYS = ['cfid', 'ctid', 'reasonid', 'reasonmsg', 'invokerid', 'invokername', 'invokeruid']
+
+"""
+Client properties, that are announced by the client events, but not returned by `clientlist`. They are kept, when the
+model is replaced by a `clientlist` snapshot
+"""
+_EVENT_ONLY_CLIENT_KEYS = ['client_flag_avatar']
+
+"""
+Keys of the channel events, that describe the event and not the channel
+"""
+_CHANNEL_EVENT_KEYS = ['cpid', 'order', 'reasonid', 'invokerid', 'invokername', 'invokeruid']
+
+
+class ServerState(object):
+    """
+    In-memory model of the clients and channels of a virtual server. It is kept up to date by a
+    `ServerStateListener`, so reading from it does not need any query command.
+    Clients and channels are stored as the dict-representation returned by the `clientlist` and `channellist`
+    commands. Every change increments `version`.
+    Channel names, client nicknames and the channel tree are indexed. The indexes are updated by the same events as the
+    model, so lookups don't scan the clients or channels.
+    """
+
+    """
+    Number of server text messages that are kept
+    """
+    MESSAGE_HISTORY_SIZE = 50
+
+    def __init__(self) -> None:
+        self.clients: dict[str, dict[str, str]] = dict()
+        self.channels: dict[str, dict[str, str]] = dict()
+        self.server: dict[str, str] = dict()
+        self.messages: deque = deque(maxlen=ServerState.MESSAGE_HISTORY_SIZE)
+        self.version = 0
+        self.synchronized = False
+        self._channel_ids_by_name: dict[str, list[str]] = dict()
+        self._client_ids_by_nickname: dict[str, list[str]] = dict()
+        self._child_channel_ids: dict[str, list[str]] = dict()
+        self._condition = Condition()
+        self._listeners: list[typing.Callable[[str, dict[str, str]], None]] = list()
+        self._handlers = {'notifycliententerview': self._client_entered,
+                          'notifyclientleftview': self._client_left,
+                          'notifyclientmoved': self._client_moved,
+                          'notifyclientupdated': self._client_updated,
+                          'notifychannelcreated': self._channel_created,
+                          'notifychanneledited': self._channel_edited,
+                          'notifychanneldescriptionchanged': self._channel_edited,
+                          'notifychannelpasswordchanged': self._channel_edited,
+                          'notifychannelmoved': self._channel_moved,
+                          'notifychanneldeleted': self._channel_deleted,
+                          'notifyserveredited': self._server_edited,
+                          'notifytextmessage': self._text_message}
+
+    def reset(self, clients: list[dict[str, str]], channels: list[dict[str, str]]) -> None:
+        """
+        Replace the whole model with a fresh snapshot
+        :param clients: The response of the `clientlist` command
+        :param channels: The response of the `channellist` command
+        """
+        with self._condition:
+            previous_clients = self.clients
+            self.clients = {client[TeamspeakCommonKeys.CLIENT_ID]: dict(client) for client in clients}
+            for client_id, client in self.clients.items():
+                ServerState._keep_event_fields(client, previous_clients.get(client_id))
+            self.channels = {channel[TeamspeakCommonKeys.CHANNEL_ID]: dict(channel) for channel in channels}
+            self._channel_ids_by_name.clear()
+            self._client_ids_by_nickname.clear()
+            self._child_channel_ids.clear()
+            for client_id, client in self.clients.items():
+                self._index_client(client_id, client)
+            for channel_id, channel in self.channels.items():
+                self._index_channel(channel_id, channel)
+            self.synchronized = True
+            self._changed()
+
+    def invalidate(self) -> None:
+        """
+        Mark the model as outdated, e.g. because the listener lost its connection
+        """
+        with self._condition:
+            self.synchronized = False
+            self._changed()
+
+    def apply(self, event_name: str, items: list[dict[str, str]]) -> None:
+        """
+        Apply a Teamspeak event to the model. Unknown events are ignored.
+        :param event_name: The event name, e.g. `notifyclientmoved`
+        :param items: The parsed event. Parameters that are shared by all items only appear in the first item
+        """
+        handler = self._handlers.get(event_name)
+        if handler is None or not items:
+            return None
+        with self._condition:
+            for item in items:
+                data = {**items[0], **item}
+                handler(data)
+                for listener in self._listeners:
+                    listener(event_name, data)
+            self._changed()
+
+    def add_listener(self, listener: typing.Callable[[str, dict[str, str]], None]) -> None:
+        """
+        Register a callable, that is called with the event name and the event data for every applied event.
+        Listeners are called while the model is locked, so they must not block.
+        :param listener: The callable
+        """
+        with self._condition:
+            self._listeners.append(listener)
+
+    def wait_for_change(self, version: int, timeout: float = None) -> int:
+        """
+        Block until the model changed after `version` or the timeout exceeded
+        :param version: The last version the caller has seen
+        :param timeout: Seconds to wait
+        :return: The current version
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def get_clients(self) -> list[dict[str, str]]:
+        """
+        :return: Copies of all clients
+        """
+        with self._condition:
+            return [dict(client) for client in self.clients.values()]
+
+    def get_channels(self) -> list[dict[str, str]]:
+        """
+        :return: Copies of all channels
+        """
+        with self._condition:
+            return [dict(channel) for channel in self.channels.values()]
+
+    def get_channel_ids(self) -> list[str]:
+        """
+        :return: All channel IDs
+        """
+        with self._condition:
+            return list(self.channels.keys())
+
+    def get_client_channel_id(self, client_id: str) -> typing.Optional[str]:
+        """
+        :param client_id: The client ID
+        :return: The ID of the channel the client is in or `None`, if the client is not connected
+        """
+        with self._condition:
+            client = self.clients.get(client_id)
+            return client.get(TeamspeakCommonKeys.CHANNEL_ID) if client is not None else None
+
+    def get_client_id_by_nickname(self, nickname: str) -> str:
+        """
+        :param nickname: The clients nickname
+        :return: The clients ID or an empty string, if no client with that nickname is connected
+        """
+        with self._condition:
+            client_ids = self._client_ids_by_nickname.get(nickname)
+            return client_ids[0] if client_ids else str()
+
+    def get_channel_id_by_name(self, name: str) -> str:
+        """
+        :param name: The channel name. Names are only unique among sibling channels, so the channel that was indexed
+                     first is returned for a name that is used more than once
+        :return: The channel ID or an empty string, if no channel has that name
+        """
+        with self._condition:
+            channel_ids = self._channel_ids_by_name.get(name)
+            return channel_ids[0] if channel_ids else str()
+
+    def get_parent_channel_id(self, channel_id: str) -> typing.Optional[str]:
+        """
+        :param channel_id: The channel ID
+        :return: The ID of the parent channel, `0` for a top level channel or `None`, if the channel does not exist
+        """
+        with self._condition:
+            channel = self.channels.get(channel_id)
+            return channel.get('pid', '0') if channel is not None else None
+
+    def get_child_channel_ids(self, channel_id: str = '0') -> list[str]:
+        """
+        :param channel_id: The channel ID. Defaults to `0`, the virtual root of all top level channels
+        :return: The IDs of the direct sub channels
+        """
+        with self._condition:
+            return list(self._child_channel_ids.get(channel_id, list()))
+
+    def _changed(self) -> None:
+        self.version += 1
+        self._condition.notify_all()
+
+    @staticmethod
+    def _index_add(index: dict[str, list[str]], key: typing.Optional[str], value: str) -> None:
+        if key is not None and value not in index.setdefault(key, list()):
+            index[key].append(value)
+
+    @staticmethod
+    def _index_remove(index: dict[str, list[str]], key: typing.Optional[str], value: str) -> None:
+        values = index.get(key)
+        if values is not None and value in values:
+            values.remove(value)
+            if not values:
+                del index[key]
+
+    def _index_client(self, client_id: str, client: dict[str, str]) -> None:
+        ServerState._index_add(self._client_ids_by_nickname, client.get(TeamspeakCommonKeys.CLIENT_NICKNAME),
+                               client_id)
+
+    def _unindex_client(self, client_id: str, client: dict[str, str]) -> None:
+        ServerState._index_remove(self._client_ids_by_nickname, client.get(TeamspeakCommonKeys.CLIENT_NICKNAME),
+                                  client_id)
+
+    def _index_channel(self, channel_id: str, channel: dict[str, str]) -> None:
+        ServerState._index_add(self._channel_ids_by_name, channel.get(TeamspeakCommonKeys.CHANNEL_NAME), channel_id)
+        ServerState._index_add(self._child_channel_ids, channel.get('pid', '0'), channel_id)
+
+    def _unindex_channel(self, channel_id: str, channel: dict[str, str]) -> None:
+        ServerState._index_remove(self._channel_ids_by_name, channel.get(TeamspeakCommonKeys.CHANNEL_NAME),
+                                  channel_id)
+        ServerState._index_remove(self._child_channel_ids, channel.get('pid', '0'), channel_id)
+
+    def _client_entered(self, data: dict[str, str]) -> None:
+        client = {key: value for key, value in data.items() if key not in _CLIENT_EVENT_KEYS}
+        client[TeamspeakCommonKeys.CHANNEL_ID] = data['ctid']
+        # The event does not carry the idle time, but a client that just joined is not idle
+        client.setdefault('client_idle_time', '0')
+        client_id = data[TeamspeakCommonKeys.CLIENT_ID]
+        self._client_left(data)
+        self.clients[client_id] = client
+        self._index_client(client_id, client)
+
+    def _client_left(self, data: dict[str, str]) -> None:
+        client = self.clients.pop(data[TeamspeakCommonKeys.CLIENT_ID], None)
+        if client is not None:
+            self._unindex_client(data[TeamspeakCommonKeys.CLIENT_ID], client)
+
+    def _client_updated(self, data: dict[str, str]) -> None:
+        client_id = data[TeamspeakCommonKeys.CLIENT_ID]
+        client = self.clients.get(client_id)
+        if client is not None:
+            self._unindex_client(client_id, client)
+            client.update({key: value for key, value in data.items() if key not in _CLIENT_EVENT_KEYS})
+            self._index_client(client_id, client)
+
+    @staticmethod
+    def _keep_event_fields(client: dict[str, str], previous: typing.Optional[dict[str, str]]) -> None:
+        # A client id is only reused after the client left, so the fields only belong to the same client, if the unique
+        # identifier is still the same
+        if previous is None or previous.get(TeamspeakCommonKeys.CLIENT_UNIQUE_IDENTIFIER) != \
+                client.get(TeamspeakCommonKeys.CLIENT_UNIQUE_IDENTIFIER):
+            return None
+        for key in _EVENT_ONLY_CLIENT_KEYS:
+            if key not in client and key in previous:
+                client[key] = previous[key]
+
+    def _client_moved(self, data: dict[str, str]) -> None:
+        client = self.clients.get(data[TeamspeakCommonKeys.CLIENT_ID])
+        if client is not None:
+            client[TeamspeakCommonKeys.CHANNEL_ID] = data['ctid']
+
+    def _channel_created(self, data: dict[str, str]) -> None:
+        channel = {key: value for key, value in data.items() if key not in _CHANNEL_EVENT_KEYS}
+        channel['pid'] = data.get('cpid', '0')
+        channel_id = data[TeamspeakCommonKeys.CHANNEL_ID]
+        if channel_id in self.channels:
+            self._unindex_channel(channel_id, self.channels[channel_id])
+        self.channels[channel_id] = channel
+        self._index_channel(channel_id, channel)
+
+    def _channel_edited(self, data: dict[str, str]) -> None:
+        channel_id = data[TeamspeakCommonKeys.CHANNEL_ID]
+        channel = self.channels.get(channel_id)
+        if channel is not None:
+            self._unindex_channel(channel_id, channel)
+            channel.update({key: value for key, value in data.items() if key not in _CHANNEL_EVENT_KEYS})
+            self._index_channel(channel_id, channel)
+
+    def _channel_moved(self, data: dict[str, str]) -> None:
+        channel_id = data[TeamspeakCommonKeys.CHANNEL_ID]
+        channel = self.channels.get(channel_id)
+        if channel is not None:
+            self._unindex_channel(channel_id, channel)
+            channel['pid'] = data.get('cpid', channel.get('pid'))
+            channel['channel_order'] = data.get('order', channel.get('channel_order'))
+            self._index_channel(channel_id, channel)
+
+    def _channel_deleted(self, data: dict[str, str]) -> None:
+        channel_id = data[TeamspeakCommonKeys.CHANNEL_ID]
+        channel = self.channels.pop(channel_id, None)
+        if channel is not None:
+            self._unindex_channel(channel_id, channel)
+        # Sub channels are deleted with their parent
+        for child_channel_id in list(self._child_channel_ids.get(channel_id, list())):
+            self._channel_deleted({TeamspeakCommonKeys.CHANNEL_ID: child_channel_id})
+
+    def _server_edited(self, data: dict[str, str]) -> None:
+        self.server.update({key: value for key, value in data.items() if key.startswith('virtualserver_')})
+
+    def _text_message(self, data: dict[str, str]) -> None:
+        self.messages.append(data)
+
+
+class ServerStateListener(Thread):
+    """
+    Background thread, that registers for server, channel and textserver notifications on a dedicated query connection
+    and applies the received events to a `ServerState`.
+    Not all client properties are announced by events (e.g. the idle time), so the model is also refreshed with a full
+    snapshot every `Configuration.server_state_resync_interval` seconds.
+    """
+
+    """
+    Seconds to wait before subscribing again, after the connection got lost
+    """
+    RETRY_INTERVAL = 5
+
+    def __init__(self, state: ServerState, configuration: Configuration = None, server_id: int = None) -> None:
+        """
+        :param state: The `ServerState` that should be kept up to date
+        :param configuration: `Configuration` object, `Configuration.get_instance()` is used if this is not set
+        :param server_id: The virtual server to listen to. Defaults to `Configuration.server_id`
+        """
+        self.configuration = configuration if configuration is not None else Configuration.get_instance()
+        self.connection = QueryConnection(self.configuration, server_id)
+        super().__init__(name=f'tsviewer-server-state-{self.connection.server_id}', daemon=True)
+        self.state = state
+        self._stopped = Event()
+        self._last_snapshot = 0.0
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self._subscribe()
+                self._listen()
+            except (ts3.TS3Error, *CONNECTION_ERRORS) as error:
+                logger.error(f'Listening to server notifications failed: {error}')
+                self.state.invalidate()
+                self.connection.close()
+                self._stopped.wait(ServerStateListener.RETRY_INTERVAL)
+        self.connection.close()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _subscribe(self) -> None:
+        self.connection.open()
+        self.connection.servernotifyregister(event='server')
+        self.connection.servernotifyregister(event='channel', id_=0)
+        self.connection.servernotifyregister(event='textserver')
+        self._snapshot()
+        logger.info('Registered for server notifications')
+
+    def _snapshot(self) -> None:
+        clients = self.connection.send('clientlist', options=CLIENT_LIST_OPTIONS).parsed
+        channels = self.connection.channellist().parsed
+        self.state.reset(clients, channels)
+        self._last_snapshot = time.monotonic()
+
+    def _listen(self) -> None:
+        connected_since = self.connection.connected_since
+        interval = self.configuration.query_keepalive_interval
+        while not self._stopped.is_set():
+            if self.connection.connected_since != connected_since:
+                # The connection was re-opened by a failing command, so the registrations are gone
+                return None
+            if time.monotonic() - self._last_snapshot >= self.configuration.server_state_resync_interval:
+                self._snapshot()
+            if self.connection.idle_time >= interval:
+                self.connection.send_keepalive()
+            event = self.connection.wait_for_event(timeout=min(interval, 1))
+            if event is not None:
+                self.state.apply(event.event, event.parsed)
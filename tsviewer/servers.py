@@ -0,0 +1,83 @@
+import typing
+
+from tsviewer.avatar_cache import AvatarCache
+from tsviewer.channel_uploads import ChannelUploads
+from tsviewer.client_rules import ClientRuleEngine
+from tsviewer.configuration import Configuration, get_server_ids
+from tsviewer.connection_pool import QueryConnectionPool
+from tsviewer.query_connection import Heartbeat
+from tsviewer.ts_viewer_client import TsViewerClient
+
+__all__ = ['MonitoredServer', 'ServerRegistry']
+
+
+class MonitoredServer(object):
+    """
+    Everything the TsViewer keeps per virtual server: the client with its `ServerState`, the channel uploads, the
+    client rules and any per-server worker the application attaches, e.g. a `UserListBroadcaster`.
+    `rules` is `None`, if `Configuration.server_state_enabled` is not set, because the rules need the server state.
+    """
+
+    def __init__(self, server_id: int, client: TsViewerClient, uploads: ChannelUploads,
+                 rules: typing.Optional[ClientRuleEngine]) -> None:
+        self.server_id = server_id
+        self.client = client
+        self.uploads = uploads
+        self.rules = rules
+        self.user_events = None
+
+    @property
+    def key(self) -> str:
+        """
+        :return: The server id as string, as it appears in URLs
+        """
+        return str(self.server_id)
+
+
+class ServerRegistry(object):
+    """
+    Watches all virtual servers of `Configuration.server_ids` from one process. The clients of all servers share one
+    `QueryConnectionPool`, one `Heartbeat` and one `AvatarCache`, while each server keeps its own state and caches.
+    """
+
+    def __init__(self, configuration: Configuration = None) -> None:
+        """
+        :param configuration: `Configuration` object, `Configuration.get_instance()` is used if this is not set
+        """
+        self.configuration = configuration if configuration is not None else Configuration.get_instance()
+        self.pool = QueryConnectionPool(self.configuration)
+        self.heartbeat = Heartbeat(lambda: [self.pool], self.configuration.query_keepalive_interval)
+        avatar_cache = AvatarCache()
+        self._servers: dict[str, MonitoredServer] = dict()
+        for server_id in get_server_ids(self.configuration):
+            client = TsViewerClient(server_id, self.pool, avatar_cache)
+            uploads = ChannelUploads(client)
+            client.uploads = uploads
+            rules = None
+            if self.configuration.server_state_enabled:
+                rules = ClientRuleEngine(client)
+                rules.start()
+            self._servers[str(server_id)] = MonitoredServer(server_id, client, uploads, rules)
+        self.heartbeat.start()
+
+    @property
+    def default(self) -> MonitoredServer:
+        """
+        :return: The server of `Configuration.server_id`
+        """
+        return self._servers[str(self.configuration.server_id)]
+
+    def get(self, server_id: typing.Optional[typing.Union[int, str]]) -> typing.Optional[MonitoredServer]:
+        """
+        :param server_id: A virtual server id or `None` for the default server
+        :return: The server or `None`, if that server is not watched
+        """
+        if server_id is None:
+            return self.default
+        return self._servers.get(str(server_id))
+
+    def __iter__(self) -> typing.Iterator[MonitoredServer]:
+        return iter(self._servers.values())
+
+    def __len__(self) -> int:
+        return len(self._servers)
@@ -32,6 +32,13 @@ class File(object):
         self.type = type
         self.url = url
 
+    def to_dict(self) -> dict[str, Optional[str]]:
+        """
+        :return: A dict-representation of the file for JSON serialization
+        """
+        return {'cid': self.cid, 'path': self.path, 'name': self.name, 'size': self.size, 'datetime': self.datetime,
+                'type': self.type}
+
     def __repr__(self) -> str:
         return f'File[cid={self.cid}, path={self.path}, size={self.size}, datetime={self.datetime}]'
 
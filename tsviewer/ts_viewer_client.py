@@ -1,16 +1,33 @@
+import os
+import pathlib
 import typing
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import ts3
 import random
 
-from tsviewer.clientinfo import ClientInfo
-from tsviewer.configuration import authorize, Configuration
+from tsviewer.avatar_cache import AvatarCache
+from tsviewer.clientinfo import ClientInfo, ClientView
+from tsviewer.configuration import Configuration
 from tsviewer.logger import logger
+from tsviewer.connection_pool import QueryConnectionPool, BoundConnectionPool
+from tsviewer.file_transfers import upload_file, upload_stream, download_file_to_path
+from tsviewer.query_connection import Heartbeat, QueryBatch
+from tsviewer.server_state import ServerState, ServerStateListener
 from tsviewer.user import User
 from tsviewer.ts_viewer_utils import TeamspeakCommonKeys, SendMessageIdentifiers, display_error,\
-    _get_possible_file_names
+    _get_possible_file_names, get_base64_hash_client_uid, CLIENT_LIST_OPTIONS
 from tsviewer.path_utils import resolve_with_project_path
 
+"""
+The `ClientInfo` fields a `User` needs for displaying purposes
+"""
+# `clientlist` does not carry `client_flag_avatar`. The `ServerState` learns it from the client events and the
+# `AvatarCache` remembers it, so `clientinfo` is only needed for clients that are known to neither of them
+USER_CLIENT_INFO_FIELDS = ['client_nickname', 'client_idle_time', 'client_input_muted', 'client_output_muted',
+                           'client_base64HashClientUID', 'client_flag_avatar']
+
 
 # TODO: Error handling with msg=ok and statuscode check where needed
 class TsViewerClient(object):
@@ -18,54 +35,94 @@ class TsViewerClient(object):
     This class is essentially a wrapper around the `ts3`-API.
     It provides some extra methods and uses the configuration to acquire a connection to the Teamspeak Server.
     """
-    _connection: typing.Optional[ts3.query.TS3Connection]
+    pool: BoundConnectionPool
+
+    """
+    Error id of a `clientmove` into the channel the client is already in
+    """
+    ALREADY_MEMBER_OF_CHANNEL_ERROR = '770'
+
+    """
+    Error id of a `ftinitupload` without `overwrite` for a file name, that is already taken
+    """
+    FILE_ALREADY_EXISTS_ERROR = '2050'
 
-    def __init__(self) -> None:
+    def __init__(self, server_id: int = None, pool: QueryConnectionPool = None,
+                 avatar_cache: AvatarCache = None) -> None:
         """
         Connects and authorizes against the configurated Teamspeak Server.
         Exit the application if not connection could be build
+        :param server_id: The virtual server of this client. Defaults to `Configuration.server_id`
+        :param pool: A pool shared with the clients of other virtual servers. The owner of a shared pool has to keep
+                     it alive with a `Heartbeat`. If this is not set, the client creates its own pool and heartbeat
+        :param avatar_cache: An `AvatarCache` shared with the clients of other virtual servers
         """
         self._connection_retries = 0
-        self._connection = None
         self.configuration = Configuration.get_instance()
-        self.channel_ids = self.get_channel_id_list()
+        self.server_id = server_id if server_id is not None else self.configuration.server_id
+        self.heartbeat = None
+        if pool is None:
+            pool = QueryConnectionPool(self.configuration)
+            self.heartbeat = Heartbeat(lambda: [pool], self.configuration.query_keepalive_interval)
+        self.pool = pool.bind(self.server_id)
+        self._connect()
+        if self.heartbeat is not None:
+            self.heartbeat.start()
+        self.state = ServerState()
+        self.state_listener = None
+        if self.configuration.server_state_enabled:
+            self.state_listener = ServerStateListener(self.state, self.configuration, self.server_id)
+            self.state_listener.start()
         self.uploads = None
+        self.avatar_cache = avatar_cache if avatar_cache is not None else AvatarCache()
 
     @property
-    def connection(self) -> ts3.query.TS3Connection:
-        not_connected = False
-        try:
-            self._connection.whoami()
-        except (ts3.TS3Error, ts3.query.TS3QueryError, ConnectionRefusedError, AttributeError, EOFError) as _:
-            logger.info('Whoami command failed')
-            not_connected = True
+    def channel_ids(self) -> list[str]:
+        """
+        All channel IDs. They are read from the `ServerState`, if it is synchronized, so created and deleted channels
+        are picked up without a query command
+        """
+        return self.get_channel_id_list()
 
-        if self._connection is None or not self._connection.is_connected() or not_connected:
+    @property
+    def connection(self) -> BoundConnectionPool:
+        """
+        Single commands can be issued on the returned pool directly, e.g. `client.connection.clientlist()`.
+        Use `self.pool.connection()` for a sequence of commands, that has to run on the same connection.
+        The liveness of the connections is tracked by `Heartbeat` and commands reconnect on their own, when the
+        connection got lost.
+        """
+        return self.pool
+
+    @contextmanager
+    def batch(self) -> typing.Iterator[QueryBatch]:
+        """
+        Collect commands and issue them pipelined on one connection when the `with` block is left, e.g.:
+            with client.batch() as batch:
+                result = batch.clientinfo(clid=5)
+            client_info = result.result()
+        """
+        batch = QueryBatch()
+        yield batch
+        with self.pool.connection() as connection:
+            batch.flush(connection)
+
+    def _connect(self) -> None:
+        while True:
+            try:
+                self.pool.fill()
+                self._connection_retries = 0
+                return None
+            except (ts3.TS3Error, OSError) as connection_error:
+                message = f'Could not connect to host at: ' \
+                          f'{self.configuration.server_query_host}:{self.configuration.server_query_port}\n'
+                display_error(message, connection_error)
+                logger.error(message, connection_error)
+            self._connection_retries += 1
             if self._connection_retries == 2:
                 logger.error('Retry failed, aborting TsViewer')
                 quit(0)
-            self._connection_retries += 1
             logger.info('Not connected to the Teamspeak server, trying to obtain connection')
-            return self._reconnect()
-        else:
-            self._connection_retries = 0
-        return self._connection
-
-    def _reconnect(self) -> ts3.query.TS3Connection:
-        if self._connection is not None:
-            self._connection.close()
-        try:
-            self._connection = ts3.query.TS3Connection(self.configuration.server_query_host,
-                                                       self.configuration.server_query_port)
-            authorize(self.configuration, self._connection)
-            # TODO: Update the channel ids at some point
-        except (ts3.TS3Error, ConnectionRefusedError) as connection_error:
-            message = f'Could not connect to host at: ' \
-                      f'{self.configuration.server_query_host}:{self.configuration.server_query_port}\n'
-            display_error(message, connection_error)
-            logger.error(message, connection_error)
-            self._connection = None
-        return self.connection
 
     def get_client_info(self, clid: str) -> ClientInfo:
         """
@@ -77,6 +134,31 @@ class TsViewerClient(object):
         # noinspection PyProtectedMember
         return ClientInfo(**self.connection.clientinfo(clid=clid)._parsed[0])
 
+    def get_client_infos(self, client_ids: list[str]) -> dict[str, ClientInfo]:
+        """
+        Issue the `clientinfo` commands for all clients pipelined, so they cost one network round trip
+        :param client_ids: Client IDs
+        :return: A mapping of the client IDs to their `ClientInfo`. Clients that left in the meantime are missing
+        """
+        with self.batch() as batch:
+            results = {client_id: batch.clientinfo(clid=client_id) for client_id in client_ids}
+        return {client_id: ClientInfo.from_partial(result.response.parsed[0])
+                for client_id, result in results.items() if not result.failed}
+
+    def complete_client_info(self, clid: str, client_info: ClientInfo, names: list[str] = None) -> ClientInfo:
+        """
+        Fill the missing fields of a partial `ClientInfo` with a `clientinfo` command. The command is only issued if
+        one of the requested fields is actually missing.
+        :param clid: Client ID
+        :param client_info: A `ClientInfo` object, e.g. created by `ClientInfo.from_partial`
+        :param names: The field names that are needed. All fields are needed if this is not set
+        :return: The same `ClientInfo` object
+        """
+        if client_info.missing_fields(names):
+            # noinspection PyProtectedMember
+            client_info.update(self.connection.clientinfo(clid=clid)._parsed[0])
+        return client_info
+
     """
     The following methods `keep_away`, `follow`, and `move_around` are all funny little utilities, that can be used
     in loops or events to cause some havoc on the Teamspeak.
@@ -114,11 +196,9 @@ class TsViewerClient(object):
         """
         Move all clients into random channels.
         """
-        for client_id in self.get_client_id_list():
-            try:
-                self.move(client_id, random.choice(self.channel_ids))
-            except ts3.TS3Error as error:
-                print(f'Clientmove failed: {error}')
+        channel_ids = self.channel_ids
+        # `move_clients` logs every failed move
+        self.move_clients([(client_id, random.choice(channel_ids)) for client_id in self.get_client_id_list()])
 
     def move(self, client_id: str, channel_id: str) -> None:
         """
@@ -126,12 +206,60 @@ class TsViewerClient(object):
         """
         self.connection.clientmove(clid=client_id, cid=channel_id)
 
+    def move_clients(self, moves: list[tuple[str, str]]) -> dict[str, typing.Optional[str]]:
+        """
+        Move many clients with one `clientmove` per target channel, e.g. `clientmove cid=2 clid=5|clid=7`. The server
+        stops a multi-client move at the first client that fails, so the clients of a failed group are moved again one
+        by one to find out which of them failed. Clients that are already in their target channel are skipped, if the
+        `ServerState` is synchronized
+        :param moves: Tuples of the client id and the target channel id. The last move of a client wins
+        :return: For every client `None` on success or the error message of the server
+        """
+        targets = dict(moves)
+        errors: dict[str, typing.Optional[str]] = dict()
+        if self.state.synchronized:
+            current_channel_ids = {client[TeamspeakCommonKeys.CLIENT_ID]: client.get(TeamspeakCommonKeys.CHANNEL_ID)
+                                   for client in self.state.get_clients()}
+            for client_id, channel_id in list(targets.items()):
+                if current_channel_ids.get(client_id) == channel_id:
+                    errors[client_id] = None
+                    del targets[client_id]
+        groups: dict[str, list[str]] = dict()
+        for client_id, channel_id in targets.items():
+            groups.setdefault(channel_id, list()).append(client_id)
+        if not groups:
+            return errors
+
+        with self.batch() as batch:
+            results = {channel_id: batch.send('clientmove', {'cid': channel_id},
+                                              [{'clid': client_id} for client_id in client_ids])
+                       for channel_id, client_ids in groups.items()}
+        failed_groups = [channel_id for channel_id, result in results.items() if result.failed]
+        for channel_id, result in results.items():
+            if not result.failed:
+                errors.update({client_id: None for client_id in groups[channel_id]})
+        retries = dict()
+        if failed_groups:
+            with self.batch() as batch:
+                retries = {client_id: batch.clientmove(clid=client_id, cid=channel_id)
+                           for channel_id in failed_groups for client_id in groups[channel_id]}
+            for client_id, result in retries.items():
+                # Clients before the failing one were already moved by the group command
+                if result.failed and result.response.error['id'] != TsViewerClient.ALREADY_MEMBER_OF_CHANNEL_ERROR:
+                    logger.error(f'Moving clid={client_id} to cid={targets[client_id]} failed: '
+                                 f'{result.response.error["msg"]}')
+                    errors[client_id] = result.response.error['msg']
+                else:
+                    errors[client_id] = None
+        logger.info(f'Issued {len(groups) + len(retries)} clientmove commands for {len(targets)} clients')
+        return errors
+
     def get_client_id_list(self) -> list[str]:
         """
         Get a list of all client IDs besides the Query user client
         :return: A list of all client IDs
         """
-        clients = self.connection.clientlist()
+        clients = self.state.get_clients() if self.state.synchronized else self.connection.clientlist()
         return list(
             map(lambda client: client[TeamspeakCommonKeys.CLIENT_ID],
                 filter(
@@ -144,13 +272,22 @@ class TsViewerClient(object):
         :param filter_by: A callable that can filter out certain channel IDs
         :return: A list of all channel IDs
         """
-        channels = self.connection.channellist()
-        if filter_by is not None:
-            self.channel_ids = filter(channels,
-                                      list(map(lambda channel: channel[TeamspeakCommonKeys.CHANNEL_ID], channels)))
+        if self.state.synchronized:
+            channel_ids = self.state.get_channel_ids()
         else:
-            self.channel_ids = list(map(lambda channel: channel[TeamspeakCommonKeys.CHANNEL_ID], channels))
-        return self.channel_ids
+            channel_ids = [channel[TeamspeakCommonKeys.CHANNEL_ID] for channel in self.connection.channellist()]
+        if filter_by is not None:
+            channel_ids = list(filter(filter_by, channel_ids))
+        return channel_ids
+
+    def get_channel_list(self) -> list[dict[str, str]]:
+        """
+        Get all channels. The channels are read from the `ServerState`, if it is synchronized
+        :return: A list of dict-representations of the channels as returned by `channellist`
+        """
+        if self.state.synchronized:
+            return self.state.get_channels()
+        return self.connection.channellist().parsed
 
     def get_client_id_by_nickname(self, nickname: str) -> str:
         """
@@ -158,6 +295,8 @@ class TsViewerClient(object):
         :param nickname: The clients nickname
         :return: The clients ID
         """
+        if self.state.synchronized:
+            return self.state.get_client_id_by_nickname(nickname)
         clients = self.connection.clientlist()
         searched_client = next(filter(lambda client: client[TeamspeakCommonKeys.CLIENT_NICKNAME] == nickname, clients),
                                dict())
@@ -169,51 +308,258 @@ class TsViewerClient(object):
         :param name: The channel name
         :return: The channel ID
         """
+        if self.state.synchronized:
+            return self.state.get_channel_id_by_name(name)
         channels = self.connection.channellist()
         searched_channel = next(filter(lambda channel: channel[TeamspeakCommonKeys.CHANNEL_NAME] == name, channels),
                                 dict())
         return searched_channel.get(TeamspeakCommonKeys.CHANNEL_ID, str())
 
-    def get_user_list(self) -> list[User]:
+    def get_client_list(self) -> list[dict[str, str]]:
+        """
+        Return every client besides the Query user client. The clients are read from the `ServerState`, if it is
+        synchronized. Otherwise, a single `clientlist` command with all `CLIENT_LIST_OPTIONS` is issued.
+        :return: A list of dict-representations of the clients
+        """
+        if self.state.synchronized:
+            clients = self.state.get_clients()
+        else:
+            clients = self.connection.send('clientlist', options=CLIENT_LIST_OPTIONS)
+        return [client for client in clients
+                if client[TeamspeakCommonKeys.CLIENT_NICKNAME] != self.configuration.server_query_user]
+
+    def get_user_list(self, batched: bool = True) -> list[User]:
         """
         Get a list of all users represented as the `User` object. This class is a Frontend-Representation of a client
-        :return:
+        :param batched: If True, all users are built from one `clientlist` response and `clientinfo` is only issued
+                        for clients that miss a field the `User` needs, e.g. the avatar hash of a client that is neither
+                        in the `ServerState` nor in the `AvatarCache`. Otherwise, `clientinfo` is issued per client
+        :return: A list of all users
         """
+        if batched:
+            return self._get_user_list_batched()
         users = list()
         for client_id in self.get_client_id_list():
             client_info = self.get_client_info(client_id)
-            avatar_file_name = self._update_avatar(client_info.client_base64HashClientUID)
+            avatar_file_name = self._update_avatar(client_info)
             users.append(User(client_info, avatar_file_name=avatar_file_name, client_id=client_id))
+        self.avatar_cache.save()
         return users
 
-    def init_file_download(self, file_name: str, channel_id: str) -> ts3.query.TS3QueryResponse:
+    def _get_user_list_batched(self) -> list[User]:
+        clients = dict()
+        for client in self.get_client_list():
+            client = dict(client)
+            client_unique_identifier = client.get(TeamspeakCommonKeys.CLIENT_UNIQUE_IDENTIFIER)
+            if client_unique_identifier:
+                client['client_base64HashClientUID'] = get_base64_hash_client_uid(client_unique_identifier)
+            if client.get('client_flag_avatar') is None and client.get('client_base64HashClientUID'):
+                client['client_flag_avatar'] = self.avatar_cache.get_flag_avatar(
+                    AvatarCache.key(self.server_id, client['client_base64HashClientUID']))
+            clients[client[TeamspeakCommonKeys.CLIENT_ID]] = client
+
+        incomplete_client_ids = [client_id for client_id, client in clients.items()
+                                 if any(client.get(name) is None for name in USER_CLIENT_INFO_FIELDS)]
+        with self.batch() as batch:
+            results = {client_id: batch.clientinfo(clid=client_id) for client_id in incomplete_client_ids}
+        for client_id, result in results.items():
+            if not result.failed:
+                clients[client_id].update(result.response.parsed[0])
+
+        users = list()
+        for client_id, client in clients.items():
+            # The view only keeps the displayed fields, parsed once
+            client_view = ClientView.from_dict(client)
+            avatar_file_name = self._update_avatar(client_view)
+            users.append(User(client_view, avatar_file_name=avatar_file_name, client_id=client_id))
+        self.avatar_cache.save()
+        return users
+
+    def init_file_download(self, file_name: str, channel_id: str, seekpos: int = 0) -> ts3.query.TS3QueryResponse:
         """
         Initialize a file download and return the response
         :param file_name: File name of the file to be downloaded
         :param channel_id: The target channel id
+        :param seekpos: The number of bytes to skip, e.g. the size of a partially downloaded file
         :return: The response object
         """
         download_response = self.connection.ftinitdownload(clientftfid=random.randint(1, 64000),
                                                            name=f"/{file_name}",
                                                            cid=channel_id,
-                                                           seekpos=0)
+                                                           seekpos=seekpos)
 
         return download_response
 
-    def get_file_list(self, channel_id: str) -> typing.Optional[ts3.query.TS3QueryResponse]:
+    def download_channel_file(self, file_name: str, channel_id: str, path: os.PathLike,
+                              retries: int = None) -> typing.Optional[pathlib.Path]:
+        """
+        Download a channel file to disk. The file is written to `<path>.part` first and only renamed to `path` once it
+        has the size announced by the server. A broken transfer is resumed at the size of the `.part` file, also
+        across calls, so no data is transferred twice.
+        :param file_name: File name of the file in the channel
+        :param channel_id: The channel id
+        :param path: The local path of the downloaded file
+        :param retries: Number of resumed attempts. Defaults to `Configuration.file_transfer_retries`
+        :return: The path of the downloaded file or None, if the download did not succeed
+        """
+        path = pathlib.Path(path)
+        partial_path = path.with_name(path.name + '.part')
+        if retries is None:
+            retries = self.configuration.file_transfer_retries
+        for attempt in range(retries + 1):
+            offset = partial_path.stat().st_size if partial_path.is_file() else 0
+            try:
+                response = self.init_file_download(file_name, channel_id, seekpos=offset)
+            except ts3.query.TS3QueryError as exception:
+                logger.error(f'FTINITDOWNLOAD for {file_name} failed: {exception}')
+                continue
+            if offset > int(response.parsed[0].get('size', 0)):
+                # The file changed on the server, so the partial file is useless
+                partial_path.unlink()
+                continue
+            if download_file_to_path(response, partial_path, offset) is not None:
+                return partial_path.replace(path)
+        return None
+
+    def init_file_upload(self, file_name: str, channel_id: str, size: int, resume: bool = False,
+                         overwrite: bool = True) -> ts3.query.TS3QueryResponse:
+        """
+        Initialize a file upload and return the response
+        :param file_name: File name of the file in the channel
+        :param channel_id: The target channel id
+        :param size: The size of the complete file in bytes
+        :param resume: If True, the server continues a previous, incomplete upload of the same file and announces the
+                       number of bytes it already has as `seekpos`
+        :param overwrite: If True, an existing file is overwritten, unless the upload is resumed. Otherwise, the server
+                          answers with `FILE_ALREADY_EXISTS_ERROR`
+        :return: The response object
+        """
+        return self.connection.ftinitupload(clientftfid=random.randint(1, 64000),
+                                            name=f'/{file_name}',
+                                            cid=channel_id,
+                                            size=size,
+                                            overwrite=1 if overwrite and not resume else 0,
+                                            resume=1 if resume else 0)
+
+    def upload_file(self, path: os.PathLike, channel_id: str, file_name: str = None, retries: int = None,
+                    progress: typing.Callable[[int, int], None] = None) -> bool:
+        """
+        Upload a local file into a channel. The file is streamed from disk. If the transfer breaks off or the server
+        reports a different file size afterwards, it is resumed where the server stopped receiving instead of starting
+        over.
+        :param path: The local file
+        :param channel_id: The target channel id
+        :param file_name: File name of the file in the channel. Defaults to the name of the local file
+        :param retries: Number of resumed attempts. Defaults to `Configuration.file_transfer_retries`
+        :param progress: Called with the number of transferred bytes and the file size, see `upload_file`
+        :return: True if the file was uploaded
+        """
+        path = pathlib.Path(path)
+        if file_name is None:
+            file_name = path.name
+        if retries is None:
+            retries = self.configuration.file_transfer_retries
+        size = path.stat().st_size
+        for attempt in range(retries + 1):
+            try:
+                response = self.init_file_upload(file_name, channel_id, size, resume=attempt > 0)
+            except ts3.query.TS3QueryError as exception:
+                logger.error(f'FTINITUPLOAD for {file_name} failed: {exception}')
+                continue
+            if not upload_file(response, path, progress):
+                continue
+            # A connection that broke off late is not always noticed by the sender, so the size is checked as well
+            file_info = self.get_file_info(file_name, channel_id)
+            if file_info is not None and int(file_info.get('size', -1)) == size:
+                return True
+            logger.error(f'The server did not receive all of {file_name}, resuming the upload')
+        return False
+
+    def upload_stream(self, stream: typing.BinaryIO, size: int, channel_id: str, file_name: str,
+                      overwrite: bool = False) -> bool:
+        """
+        Upload the content of a stream into a channel, e.g. the body of an HTTP request. A stream can't be rewound, so
+        a broken transfer is not resumed.
+        :param stream: A readable binary stream
+        :param size: The number of bytes that are read from the stream
+        :param channel_id: The target channel id
+        :param file_name: File name of the file in the channel
+        :param overwrite: If True, an existing file with the same name is replaced
+        :return: True if the server received the whole file
+        :raises FileExistsError: If `overwrite` is False and the channel already has a file with that name
+        """
+        try:
+            response = self.init_file_upload(file_name, channel_id, size, overwrite=overwrite)
+        except ts3.query.TS3QueryError as exception:
+            if exception.resp.error['id'] == TsViewerClient.FILE_ALREADY_EXISTS_ERROR:
+                raise FileExistsError(f'{file_name} already exists in cid={channel_id}')
+            logger.error(f'FTINITUPLOAD for {file_name} failed: {exception}')
+            return False
+        if not upload_stream(response, stream, size):
+            return False
+        file_info = self.get_file_info(file_name, channel_id)
+        return file_info is not None and int(file_info.get('size', -1)) == size
+
+    def get_file_info(self, file_name: str, channel_id: str) -> typing.Optional[dict[str, str]]:
+        """
+        :param file_name: File name of the file in the channel
+        :param channel_id: The channel id
+        :return: The `FTGETFILEINFO` entry of the file, e.g. with its `size`, or None if the file does not exist
         """
-        Get a list of all files in a channel
+        try:
+            return self.connection.ftgetfileinfo(cid=channel_id, name=f'/{file_name}').parsed[0]
+        except ts3.query.TS3QueryError as exception:
+            logger.debug(exception)
+            return None
+
+    def get_file_list(self, channel_id: str, path: str = '/') -> typing.Optional[ts3.query.TS3QueryResponse]:
+        """
+        Get a list of all files in a directory of a channel
         :param channel_id: The target channel id
+        :param path: The directory within the channel, e.g. `/` or `/screenshots`
         :return: The response or None if an exception was raised
         """
         response = None
         try:
-            response = self.connection.ftgetfilelist(cid=channel_id, path='/')
+            response = self.connection.ftgetfilelist(cid=channel_id, path=path)
         except ts3.query.TS3QueryError as exception:
             # We use debug here, because usually an exception is thrown when the channel is just empty
             logger.debug(exception)
         return response
 
+    def get_file_lists(self, channel_ids: list[str],
+                       max_connections: int = None) -> dict[str, typing.Optional[ts3.query.TS3QueryResponse]]:
+        """
+        Get the files of several channels with pipelined `ftgetfilelist` commands. The channels are split into one
+        batch per pooled connection and the batches run concurrently
+        :param channel_ids: The target channel ids
+        :param max_connections: Maximum number of pooled connections to use. Defaults to the size of the pool
+        :return: A mapping of the channel ids to their response or None if the channel has no files
+        """
+        max_connections = max_connections if max_connections is not None else self.pool.max_size
+        chunk_count = max(1, min(max_connections, len(channel_ids)))
+        chunks = [channel_ids[index::chunk_count] for index in range(chunk_count)]
+        if chunk_count == 1:
+            return self._get_file_lists(channel_ids)
+        file_lists = dict()
+        with ThreadPoolExecutor(max_workers=chunk_count, thread_name_prefix='tsviewer-file-list') as executor:
+            for chunk_file_lists in executor.map(self._get_file_lists, chunks):
+                file_lists.update(chunk_file_lists)
+        return {channel_id: file_lists[channel_id] for channel_id in channel_ids}
+
+    def _get_file_lists(self, channel_ids: list[str]) -> dict[str, typing.Optional[ts3.query.TS3QueryResponse]]:
+        with self.batch() as batch:
+            results = {channel_id: batch.ftgetfilelist(cid=channel_id, path='/') for channel_id in channel_ids}
+        file_lists = dict()
+        for channel_id, result in results.items():
+            if result.failed:
+                # We use debug here, because usually an error is returned when the channel is just empty
+                logger.debug(ts3.query.TS3QueryError(result.response))
+                file_lists[channel_id] = None
+            else:
+                file_lists[channel_id] = result.response
+        return file_lists
+
     def edit_channel_description(self, channel_id: str, text: str) -> None:
         """
         Edit a channels' description
@@ -222,25 +568,39 @@ class TsViewerClient(object):
         """
         self.connection.channeledit(cid=channel_id, channel_description=text)
 
-    def move_file(self, channel_id: str, target_channel_id: str, file_name: str, new_file_name: str = None) -> None:
+    def move_file(self, channel_id: str, target_channel_id: str, file_name: str, new_file_name: str = None) -> bool:
         """
         Moves (or renames) a file
         :param channel_id: The channel id where the file currently is located at
         :param target_channel_id: The target channel id
         :param file_name: The file name of the file
         :param new_file_name: The new name for the file after moving it (optional)
-        """
-        if new_file_name is None:
-            new_file_name = file_name
-        try:
-            self.connection.ftrenamefile(cid=channel_id,
-                                         tcid=target_channel_id,
-                                         oldname=f'/{file_name}', newname=f'/{new_file_name}',
-                                         tcpw=str(), cpw=str())
-            logger.info(f'File successfully moved from cid={channel_id} to tcid={target_channel_id}')
-        except ts3.query.TS3QueryError as exception:
-            logger.error(exception)
-            quit()
+        :return: True if the file was moved
+        """
+        return self.move_files([(channel_id, target_channel_id, file_name, new_file_name)])[0] is None
+
+    def move_files(self, moves: list[tuple[str, str, str, typing.Optional[str]]]) -> list[typing.Optional[str]]:
+        """
+        Move (or rename) several files with pipelined `ftrenamefile` commands. A failing move does not affect the others
+        :param moves: Tuples of the channel id, the target channel id, the file name and the new file name. The file
+                      keeps its name if the new file name is None
+        :return: For every move `None` on success or the error message of the server
+        """
+        with self.batch() as batch:
+            results = [batch.ftrenamefile(cid=channel_id, tcid=target_channel_id, oldname=f'/{file_name}',
+                                          newname=f'/{new_file_name if new_file_name is not None else file_name}',
+                                          tcpw=str(), cpw=str())
+                       for channel_id, target_channel_id, file_name, new_file_name in moves]
+        errors = list()
+        for (channel_id, target_channel_id, file_name, _), result in zip(moves, results):
+            if result.failed:
+                logger.error(f'Moving {file_name} from cid={channel_id} to tcid={target_channel_id} failed: '
+                             f'{result.response.error["msg"]}')
+                errors.append(result.response.error['msg'])
+            else:
+                logger.info(f'File successfully moved from cid={channel_id} to tcid={target_channel_id}')
+                errors.append(None)
+        return errors
 
     def who_am_i(self) -> ts3.query.TS3QueryResponse:
         """
@@ -262,14 +622,16 @@ class TsViewerClient(object):
         :param message: Message text
         :param channel_id: Target channel id
         """
-        who_am_i = self.who_am_i().parsed
-        serveradmin_client_id = who_am_i[0]['client_id']
+        # The query client is moved, so all commands have to run on the same connection
+        with self.pool.connection() as connection:
+            who_am_i = connection.whoami().parsed
+            serveradmin_client_id = who_am_i[0]['client_id']
 
-        # Move to target channel
-        self.connection.clientmove(clid=serveradmin_client_id, cid=channel_id)
+            # Move to target channel
+            connection.clientmove(clid=serveradmin_client_id, cid=channel_id)
 
-        # Send the message (Maybe we should move back afterwards?)
-        self.connection.sendtextmessage(targetmode=SendMessageIdentifiers.TO_CHANNEL, msg=message, target='')
+            # Send the message (Maybe we should move back afterwards?)
+            connection.sendtextmessage(targetmode=SendMessageIdentifiers.TO_CHANNEL, msg=message, target='')
 
     def send_message_to_server(self, message: str) -> None:
         """
@@ -288,12 +650,26 @@ class TsViewerClient(object):
             message = ''
         self.connection.clientpoke(msg=message, clid=client_id)
 
-    def _update_avatar(self, client_base64_hash_uid: str) -> typing.Optional[str]:
+    def _update_avatar(self, client: typing.Union[ClientInfo, ClientView]) -> typing.Optional[str]:
+        if isinstance(client, ClientInfo):
+            client = ClientView.from_client_info(client)
+        client_base64_hash_uid = client.base64_hash_client_uid
+        if client.flag_avatar == str():
+            # The client has no avatar at all
+            return None
+        cache_key = AvatarCache.key(self.server_id, client_base64_hash_uid)
+        hit, avatar_file_name = self.avatar_cache.lookup(cache_key, client.flag_avatar)
+        if hit:
+            return avatar_file_name
         file_name = f'avatar_{client_base64_hash_uid}'
-        self.uploads.download_avatar(file_name)
-        avatar_file_name = None
-        for possible_path in _get_possible_file_names(file_name):
+        # The same identity may have another avatar on another virtual server, so only the default server keeps the
+        # file name of the avatar channel
+        local_file_name = file_name if str(self.server_id) == str(self.configuration.server_id) \
+            else f'avatar_{self.server_id}_{client_base64_hash_uid}'
+        self.uploads.download_avatar(file_name, local_file_name)
+        for possible_path in _get_possible_file_names(local_file_name):
             absolute_path = resolve_with_project_path('static/avatars/' + possible_path)
             if absolute_path.is_file():
                 avatar_file_name = 'avatars/' + possible_path
+        self.avatar_cache.store(cache_key, client.flag_avatar, avatar_file_name)
         return avatar_file_name
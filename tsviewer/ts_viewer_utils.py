@@ -1,8 +1,19 @@
+from base64 import b64decode
+from typing import Optional
+
+
 class TeamspeakCommonKeys(object):
     CLIENT_ID = 'clid'
     CHANNEL_ID = 'cid'
     CLIENT_NICKNAME = 'client_nickname'
     CHANNEL_NAME = 'channel_name'
+    CLIENT_UNIQUE_IDENTIFIER = 'client_unique_identifier'
+
+
+"""
+Options for the `clientlist` command, so that a single response carries everything needed to build a `User`
+"""
+CLIENT_LIST_OPTIONS = ['uid', 'away', 'voice', 'times', 'info', 'country', 'icon', 'groups']
 
 
 class KickClientIdentifiers(object):
@@ -148,6 +159,21 @@ def _get_possible_file_names(base_name: str) -> list[str]:
             f'{base_name}.webp']
 
 
+def get_base64_hash_client_uid(client_unique_identifier: str) -> Optional[str]:
+    """
+    Compute the `client_base64HashClientUID` of a client locally, so no `clientinfo` command is needed for it.
+    Teamspeak decodes the base64 encoded client uid, formats it as hex and maps every hex digit `0-f` to the
+    letters `a-p`. This is also the name of the client's avatar file (prefixed with `avatar_`)
+    :param client_unique_identifier: The client uid as returned by `clientlist -uid`
+    :return: The `client_base64HashClientUID` or `None` if the uid is not base64 encoded (e.g. for query clients)
+    """
+    try:
+        digits = b64decode(client_unique_identifier, validate=True).hex()
+    except ValueError:
+        return None
+    return digits.translate(str.maketrans('0123456789abcdef', 'abcdefghijklmnop'))
+
+
 def __generate_dataclass(name: str, source: dict[str, str]) -> str:
     """
     Generate code for a dataclass like `Clientinfo` by a given dict.
@@ -0,0 +1,118 @@
+import typing
+from dataclasses import dataclass, field
+from json import load, dump, JSONDecodeError
+from threading import Lock
+
+from tsviewer.configuration import Configuration
+from tsviewer.logger import logger
+from tsviewer.path_utils import resolve_with_project_path
+
+__all__ = ['UploadCleanupJournal', 'CleanupReport']
+
+
+@dataclass
+class CleanupReport:
+    """
+    Summary of an upload channel cleanup. `failed` maps the `<cid>/<file name>` of each file that could not be moved
+    to the error message of the server
+    """
+    moved: list[str] = field(default_factory=list)
+    failed: dict[str, str] = field(default_factory=dict)
+    skipped: list[str] = field(default_factory=list)
+
+
+class UploadCleanupJournal(object):
+    """
+    Persistent record of the files the upload channel cleanup already processed. Each entry is keyed by
+    `<cid>/<file name>` of the source file and remembers the size and timestamp of the file, whether it was moved or
+    failed, and how often moving it was attempted. A file with the same size and timestamp is not moved again, so a
+    stale file listing does not cause duplicate renames, and a file that keeps failing is given up on after
+    `Configuration.upload_cleanup_max_attempts` attempts.
+    """
+
+    MOVED = 'moved'
+    FAILED = 'failed'
+
+    def __init__(self, path: str = None) -> None:
+        """
+        :param path: Path to the journal file. Defaults to `Configuration.upload_cleanup_state_path`
+        """
+        self.path = resolve_with_project_path(path if path is not None
+                                              else Configuration.get_instance().upload_cleanup_state_path)
+        self._lock = Lock()
+        self._dirty = False
+        self._entries: dict[str, dict[str, typing.Any]] = self._load()
+
+    @staticmethod
+    def key(channel_id: str, file_name: str) -> str:
+        return f'{channel_id}/{file_name}'
+
+    def should_move(self, channel_id: str, file: dict[str, str], max_attempts: int) -> bool:
+        """
+        :param channel_id: The channel the file is located in
+        :param file: The `FTGETFILELIST` entry of the file
+        :param max_attempts: Number of failed attempts after which a file is given up on
+        :return: True if the file was not processed yet, changed since, or may be retried
+        """
+        with self._lock:
+            entry = self._entries.get(UploadCleanupJournal.key(channel_id, file['name']))
+        if entry is None or entry.get('size') != file.get('size') or entry.get('datetime') != file.get('datetime'):
+            return True
+        if entry.get('status') == UploadCleanupJournal.MOVED:
+            return False
+        return entry.get('attempts', 0) < max_attempts
+
+    def record(self, channel_id: str, file: dict[str, str], error: typing.Optional[str]) -> None:
+        """
+        Remember the outcome of a move. Call `save` to persist the journal
+        :param channel_id: The channel the file was located in
+        :param file: The `FTGETFILELIST` entry of the file
+        :param error: The error message of the server or `None`, if the file was moved
+        """
+        key = UploadCleanupJournal.key(channel_id, file['name'])
+        with self._lock:
+            entry = self._entries.get(key, dict())
+            same_file = entry.get('size') == file.get('size') and entry.get('datetime') == file.get('datetime')
+            attempts = entry.get('attempts', 0) + 1 if same_file else 1
+            status = UploadCleanupJournal.MOVED if error is None else UploadCleanupJournal.FAILED
+            self._entries[key] = {'size': file.get('size'), 'datetime': file.get('datetime'), 'status': status,
+                                  'attempts': attempts, 'error': error}
+            self._dirty = True
+
+    def prune(self, keys: typing.Iterable[str]) -> None:
+        """
+        Forget all entries except the given ones, e.g. entries of files that are no longer listed
+        :param keys: The keys that are kept
+        """
+        keys = set(keys)
+        with self._lock:
+            stale = [key for key in self._entries if key not in keys]
+            for key in stale:
+                del self._entries[key]
+            self._dirty = self._dirty or bool(stale)
+
+    def save(self) -> None:
+        """
+        Write the journal file, if any entry changed since the last save
+        """
+        with self._lock:
+            if not self._dirty:
+                return None
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with self.path.open('w') as journal_file:
+                    dump(self._entries, journal_file)
+                self._dirty = False
+            except OSError as exception:
+                logger.error(f'Could not write the upload cleanup journal to {self.path}: {exception}')
+
+    def _load(self) -> dict[str, dict[str, typing.Any]]:
+        if not self.path.is_file():
+            return dict()
+        try:
+            with self.path.open('r') as journal_file:
+                return load(journal_file)
+        except (OSError, JSONDecodeError) as exception:
+            logger.error(f'Could not read the upload cleanup journal from {self.path}, starting with an empty '
+                         f'journal: {exception}')
+            return dict()
@@ -1,7 +1,8 @@
 import copy
 import typing
+from dataclasses import astuple
 
-from tsviewer.clientinfo import ClientInfo, fake_user_base_client_info
+from tsviewer.clientinfo import ClientInfo, ClientView, fake_user_base_client_info
 import random
 import string
 
@@ -10,14 +11,19 @@ from tsviewer.ts_viewer_utils import TimeUtil
 
 class User(object):
     """ User is a representation of a client's information for displaying purposes.
-     You have to provide a ``ClientInfo`` object to instantiate it"""
+     You have to provide a ``ClientInfo`` or ``ClientView`` object to instantiate it. A ``ClientInfo`` is reduced to
+     its ``ClientView`` right away, so a ``User`` only keeps the fields it displays"""
+    __slots__ = ('client_view', '_avatar_file_name', '_client_id')
 
-    def __init__(self, client_info: ClientInfo = None, avatar_file_name: typing.Optional[str] = None,
-                 client_id: typing.Optional[str] = None) -> None:
+    def __init__(self, client_info: typing.Union[ClientInfo, ClientView] = None,
+                 avatar_file_name: typing.Optional[str] = None, client_id: typing.Optional[str] = None) -> None:
         """
-        :param client_info: Instance of a ``Clientinfo`` returned by ``TsViewerClient.get_client_info()``
+        :param client_info: Instance of a ``Clientinfo`` returned by ``TsViewerClient.get_client_info()`` or a
+                            ``ClientView``
         """
-        self.client_info = client_info
+        if isinstance(client_info, ClientInfo):
+            client_info = ClientView.from_client_info(client_info)
+        self.client_view = client_info
         self._avatar_file_name = avatar_file_name
         self._client_id = client_id
 
@@ -27,8 +33,8 @@ class User(object):
         Create a string that contains an approximation of how long afk a client has been
         :return: Formatted Client AFK time
         """
-        idle_time_in_seconds = int(self.client_info.client_idle_time) / 1000
-        milliseconds = int(self.client_info.client_idle_time)
+        milliseconds = self.client_view.idle_time
+        idle_time_in_seconds = milliseconds / 1000
         if idle_time_in_seconds <= 10:
             return '-'
         elif idle_time_in_seconds <= 60:
@@ -53,7 +59,7 @@ class User(object):
         """
         :return: The Clients Nickname
         """
-        return self.client_info.client_nickname
+        return self.client_view.nickname
 
     @property
     def avatar_file_name(self) -> str:
@@ -73,7 +79,7 @@ class User(object):
         Return an icon key for display purposes
         :return: `mic-mute` or `mic` depending on the clients mic-status
         """
-        return 'mic-mute' if self.client_info.client_input_muted == '1' else 'mic'
+        return 'mic-mute' if self.client_view.input_muted else 'mic'
 
     @property
     def sound_status(self) -> str:
@@ -81,7 +87,7 @@ class User(object):
         Return an icon key for display purposes
         :return: `volume-mute` or `volume-up` depending on the clients sound-status
         """
-        return 'volume-mute' if self.client_info.client_output_muted == '1' else 'volume-up'
+        return 'volume-mute' if self.client_view.output_muted else 'volume-up'
 
     @property
     def client_id(self) -> str:
@@ -91,6 +97,34 @@ class User(object):
         """
         return self._client_id
 
+    def to_dict(self) -> dict[str, typing.Optional[str]]:
+        """
+        A compact projection of the user for JSON serialization
+        :return: A dict containing everything that is displayed for the user
+        """
+        return {'client_id': self.client_id,
+                'channel_id': self.client_view.channel_id,
+                'name': self.name,
+                'idle_time': self.idle_time,
+                'microphone_status': self.microphone_status,
+                'sound_status': self.sound_status,
+                'away': self.client_view.away,
+                'country': self.client_view.country,
+                'avatar_file_name': self.avatar_file_name}
+
+    def __eq__(self, other: typing.Any) -> bool:
+        if not isinstance(other, User):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self) -> int:
+        return hash(self._key())
+
+    def _key(self) -> tuple:
+        # `ClientView` is a mutable dataclass and can't be hashed itself, so its values are used instead
+        client_view = astuple(self.client_view) if self.client_view is not None else None
+        return client_view, self._avatar_file_name, self._client_id
+
     def __repr__(self) -> str:
         return f'User[name={self.name}]'
 
@@ -152,7 +186,7 @@ class UserBuilder(object):
         fake_user_client_info.client_nickname = self._name
         fake_user_client_info.client_base64HashClientUID = self._avatar_file_name
 
-        return User(fake_user_client_info)
+        return User(fake_user_client_info, client_id=self._client_id)
 
     def build(self) -> User:
         return User(self._client_info)
@@ -0,0 +1,116 @@
+import typing
+from json import dumps
+from queue import Queue, Empty, Full
+from threading import Thread, Lock, Event
+
+from tsviewer.configuration import Configuration
+from tsviewer.logger import logger
+from tsviewer.server_state import ServerState
+from tsviewer.user import User
+
+__all__ = ['UserListBroadcaster']
+
+
+class UserListBroadcaster(Thread):
+    """
+    Background thread, that pushes changes of the user list to all connected viewers as Server-Sent Events.
+    The user list is rebuilt once per `ServerState` change and the resulting diff is serialized once and shared by all
+    subscribers, so the work does not grow with the number of open dashboards.
+    """
+
+    """
+    Seconds after which an idle event stream sends a comment, so proxies don't close the connection
+    """
+    KEEPALIVE_INTERVAL = 15
+
+    """
+    Number of undelivered events after which a subscriber is considered too slow and dropped
+    """
+    MAX_PENDING_EVENTS = 100
+
+    def __init__(self, state: ServerState, users: typing.Callable[[], list[User]]) -> None:
+        """
+        :param state: The `ServerState` whose changes trigger a rebuild of the user list
+        :param users: A callable that builds the current user list, e.g. `RefreshScheduler.refresh` of the user list
+        """
+        super().__init__(name='tsviewer-user-events', daemon=True)
+        self.state = state
+        self._users = users
+        self._lock = Lock()
+        self._subscribers: list[Queue] = list()
+        self._projection: typing.Optional[dict[str, dict[str, typing.Optional[str]]]] = None
+        self._stopped = Event()
+
+    def run(self) -> None:
+        version = self.state.version
+        interval = Configuration.get_instance().server_state_resync_interval
+        while not self._stopped.is_set():
+            version = self.state.wait_for_change(version, timeout=interval)
+            with self._lock:
+                if not self._subscribers:
+                    # Nobody is watching, the next subscriber builds a fresh snapshot
+                    self._projection = None
+                    continue
+            try:
+                self._publish_changes()
+            except Exception as exception:
+                logger.error(f'Building the user list diff failed: {exception}')
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def stream(self) -> typing.Iterator[str]:
+        """
+        The Server-Sent Events stream of one viewer. It starts with a `snapshot` event containing the whole user list,
+        followed by `diff` events with the `joined`, `left` and `changed` users.
+        :return: A generator of event stream messages
+        """
+        subscriber = self._subscribe()
+        try:
+            while subscriber in self._subscribers:
+                try:
+                    yield subscriber.get(timeout=UserListBroadcaster.KEEPALIVE_INTERVAL)
+                except Empty:
+                    yield ': keepalive\n\n'
+        finally:
+            self._unsubscribe(subscriber)
+
+    def _subscribe(self) -> Queue:
+        subscriber = Queue(maxsize=UserListBroadcaster.MAX_PENDING_EVENTS)
+        with self._lock:
+            if self._projection is None:
+                self._projection = self._project()
+            subscriber.put_nowait(UserListBroadcaster._format('snapshot', list(self._projection.values())))
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def _unsubscribe(self, subscriber: Queue) -> None:
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def _project(self) -> dict[str, dict[str, typing.Optional[str]]]:
+        return {user.client_id: user.to_dict() for user in self._users()}
+
+    def _publish_changes(self) -> None:
+        with self._lock:
+            previous = self._projection if self._projection is not None else dict()
+            current = self._project()
+            self._projection = current
+            diff = {'joined': [user for client_id, user in current.items() if client_id not in previous],
+                    'left': [client_id for client_id in previous if client_id not in current],
+                    'changed': [user for client_id, user in current.items()
+                                if client_id in previous and previous[client_id] != user]}
+            if not any(diff.values()):
+                return None
+            message = UserListBroadcaster._format('diff', diff)
+            for subscriber in list(self._subscribers):
+                try:
+                    subscriber.put_nowait(message)
+                except Full:
+                    logger.info('Dropping a user event subscriber, that does not keep up')
+                    self._subscribers.remove(subscriber)
+
+    @staticmethod
+    def _format(event: str, data: typing.Any) -> str:
+        return f'event: {event}\ndata: {dumps(data)}\n\n'